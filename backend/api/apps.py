@@ -1,6 +1,26 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "backend.api"
+
+    def ready(self):
+        from .face_recognition_service import face_recognition_service
+        face_recognition_service.detector_model_path = getattr(settings, 'FACE_DETECTOR_ONNX_PATH', None)
+        face_recognition_service.embedder_model_path = getattr(settings, 'FACE_EMBEDDER_ONNX_PATH', None)
+        face_recognition_service.encoding_workers = getattr(settings, 'FACE_ENCODING_WORKERS', 1)
+
+        # Build the face recognition model once per process instead of on the first request.
+        if getattr(settings, 'FACE_RECOGNITION_PRELOAD', False) and not self._is_autoreload_parent():
+            face_recognition_service.warm_up()
+
+    @staticmethod
+    def _is_autoreload_parent():
+        # runserver's reloader process only watches files; the child it spawns
+        # (RUN_MAIN=true) is the one that serves requests.
+        return 'runserver' in sys.argv and os.environ.get('RUN_MAIN') != 'true'
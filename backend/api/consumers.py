@@ -1,9 +1,6 @@
 # backend/api/consumers.py - FIXED FACE RECOGNITION VERSION
 
 import json
-import base64
-import os
-import shutil
 import cv2
 import numpy as np
 import logging
@@ -12,16 +9,16 @@ from typing import Dict, Set
 from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.conf import settings
-from django.utils import timezone
-from .models import Course, Student, AttendanceRecord
+from .models import Course, Student
+from .face_recognition_service import DISTANCE_THRESHOLD, face_recognition_service
+from .tasks import course_face_gallery, mark_students_present
+from .utils import pybase64
 from deepface import DeepFace
 
 logger = logging.getLogger(__name__)
 
 # --- IMPROVED Configuration Constants ---
-MODEL_NAME = getattr(settings, 'FACE_RECOGNITION_MODEL', 'VGG-Face')  # Changed to more reliable model
-DISTANCE_METRIC = "cosine"
-RECOGNITION_THRESHOLD = getattr(settings, 'FACE_RECOGNITION_THRESHOLD', 0.50)  # Relaxed threshold
+RECOGNITION_THRESHOLD = getattr(settings, 'FACE_RECOGNITION_THRESHOLD', DISTANCE_THRESHOLD)
 SIGHTING_THRESHOLD = 2  # Reduced for faster recognition
 
 class AttendanceConsumer(AsyncWebsocketConsumer):
@@ -37,7 +34,6 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
             
         self.course_id = self.scope['url_route']['kwargs']['course_id']
         self.room_group_name = f'attendance_{self.course_id}'
-        self.db_path = os.path.join(settings.MEDIA_ROOT, f'temp_session_db_{self.course_id}_{self.channel_name}')
         
         # Session state
         self.session_recognized_students: Set[int] = set()
@@ -50,7 +46,7 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
         
         await self.accept()
         
-        success = await self.prepare_face_db_for_deepface()
+        success = await self.load_face_gallery()
         if not success:
             await self.send_error_and_close('Failed to prepare face recognition database.')
             return
@@ -61,7 +57,7 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
         self.processing_task = asyncio.create_task(self.background_processor())
         
         await self.send_json({'type': 'session_ready'})
-        logger.info(f"Attendance session started for course {self.course_id}")
+        logger.info("Attendance session started for course %s", self.course_id)
         
         
 
@@ -70,10 +66,9 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
         self.is_closing = True
         if hasattr(self, 'processing_task') and not self.processing_task.done():
             self.processing_task.cancel()
-        await self.cleanup_resources()
         if hasattr(self, 'room_group_name'):
             await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
-        logger.info(f"Attendance session ended for course {getattr(self, 'course_id', 'unknown')}")
+        logger.info("Attendance session ended for course %s", getattr(self, 'course_id', 'unknown'))
 
     async def receive(self, text_data):
         """
@@ -96,7 +91,7 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
         except json.JSONDecodeError:
             logger.warning("Received invalid JSON.")
         except Exception as e:
-            logger.error(f"Error in receive method: {e}", exc_info=True)
+            logger.exception("Error in receive method: %s", e)
 
     async def background_processor(self):
         """
@@ -108,7 +103,7 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
                 image_b64 = await self.task_queue.get()
                 
                 # Decode and process the image
-                image_data = base64.b64decode(image_b64)
+                image_data = pybase64.b64decode(image_b64)
                 nparr = np.frombuffer(image_data, np.uint8)
                 original_img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
                 
@@ -118,9 +113,9 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
                 # Run face recognition in separate thread
                 faces_data, newly_confirmed = await self._run_recognition_in_thread(original_img)
                 
-                # Mark attendance for newly confirmed students
-                for student_data in newly_confirmed:
-                    await self.mark_student_present(student_data['id'], self.course_id)
+                # Mark attendance for newly confirmed students in one insert
+                if newly_confirmed:
+                    await self.mark_students_present([student_data['id'] for student_data in newly_confirmed])
                 
                 # Send results back to client
                 if not self.is_closing:
@@ -138,7 +133,7 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
                 logger.info("Background processor task was cancelled.")
                 break
             except Exception as e:
-                logger.error(f"Error in background processor: {e}", exc_info=True)
+                logger.exception("Error in background processor: %s", e)
 
     @sync_to_async
     def _run_recognition_in_thread(self, original_img: np.ndarray):
@@ -157,8 +152,8 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
             faces_for_frontend = []
             newly_confirmed_this_frame = []
 
+            candidates = []
             for face_data in extracted_faces:
-                face_image = face_data['face']
                 face_region = face_data['facial_area']
 
                 # Step 1: Check if face is in an already confirmed location
@@ -166,35 +161,24 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
                     continue # Skip this face, it's already been confirmed
 
                 # Step 2: Assess face quality
-                if not self._is_face_high_quality(face_image, face_region):
+                if not self._is_face_high_quality(face_data['face'], face_region):
                     continue
 
-                # Step 3: Recognize the high-quality face
-                dfs = DeepFace.find(
-                    img_path=face_image,
-                    db_path=self.db_path,
-                    model_name=MODEL_NAME,
-                    distance_metric=DISTANCE_METRIC,
-                    enforce_detection=False,
-                    silent=True,
-                    threshold=RECOGNITION_THRESHOLD
-                )
-
-                if not (dfs and isinstance(dfs, list) and len(dfs) > 0 and not dfs[0].empty):
-                    continue
+                candidates.append(face_data)
 
-                df = dfs[0]
-                best_match = df.iloc[0]
-                
-                distance = float('inf')
-                distance_col_name = f"{MODEL_NAME}_{DISTANCE_METRIC}"
-                
-                if distance_col_name in df.columns:
-                    distance = best_match.get(distance_col_name, float('inf'))
-                elif 'distance' in df.columns:
-                    distance = best_match.get('distance', float('inf'))
-                else:
+            if not candidates:
+                return faces_for_frontend, newly_confirmed_this_frame
+
+            # Step 3: Embed the high-quality faces in one batch and compare them
+            # to the stored encodings with a single matrix product
+            student_ids, distances = face_recognition_service.match_face_crops(
+                [face_data['face'] for face_data in candidates], self.face_gallery
+            )
+
+            for face_data, student_id, distance in zip(candidates, student_ids.tolist(), distances.tolist()):
+                if distance > RECOGNITION_THRESHOLD:
                     continue
+                face_region = face_data['facial_area']
 
                 box = {
                     'source_x': int(face_region.get('x', 0)),
@@ -202,43 +186,30 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
                     'source_w': int(face_region.get('w', 50)),
                     'source_h': int(face_region.get('h', 50))
                 }
-                
-                result_data = {'box': box, 'name': 'Unknown', 'status': 'unknown'}
-
-                if distance <= RECOGNITION_THRESHOLD:
-                    try:
-                        identity_path = best_match['identity']
-                        filename = os.path.basename(identity_path)
-                        student_id_str = filename.split('_')[1].split('.')[0] if filename.startswith('student_') else filename.split('.')[0]
-                        student_id = int(student_id_str)
-                        
-                        student = Student.objects.get(id=student_id)
-                        result_data['name'] = f"{student.first_name} {student.last_name}".strip()
-                        
-                        if student_id in self.session_recognized_students:
-                            result_data['status'] = 'confirmed'
-                        else:
-                            current_sightings = self.session_sighting_counts.get(student_id, 0) + 1
-                            self.session_sighting_counts[student_id] = current_sightings
-                            
-                            if current_sightings >= SIGHTING_THRESHOLD:
-                                self.session_recognized_students.add(student_id)
-                                newly_confirmed_this_frame.append({'id': student.id, 'name': result_data['name']})
-                                result_data['status'] = 'confirmed'
-                                # NEW: Add the location of the newly confirmed face for tracking
-                                self.session_confirmed_face_locations.append(face_region)
-                            else:
-                                result_data['status'] = 'sighted'
-                                
-                    except (ValueError, IndexError, Student.DoesNotExist) as e:
-                        logger.warning(f"Error processing recognized face: {e}")
-                
+
+                result_data = {'box': box, 'name': self.student_names.get(student_id, 'Unknown'), 'status': 'unknown'}
+
+                if student_id in self.session_recognized_students:
+                    result_data['status'] = 'confirmed'
+                else:
+                    current_sightings = self.session_sighting_counts.get(student_id, 0) + 1
+                    self.session_sighting_counts[student_id] = current_sightings
+
+                    if current_sightings >= SIGHTING_THRESHOLD:
+                        self.session_recognized_students.add(student_id)
+                        newly_confirmed_this_frame.append({'id': student_id, 'name': result_data['name']})
+                        result_data['status'] = 'confirmed'
+                        # NEW: Add the location of the newly confirmed face for tracking
+                        self.session_confirmed_face_locations.append(face_region)
+                    else:
+                        result_data['status'] = 'sighted'
+
                 faces_for_frontend.append(result_data)
 
             return faces_for_frontend, newly_confirmed_this_frame
 
         except Exception as e:
-            logger.error(f"Error in recognition thread: {e}", exc_info=True)
+            logger.exception("Error in recognition thread: %s", e)
             return [], []
         
         
@@ -255,7 +226,7 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
         try:
             # 1. Check Resolution
             if face_region['w'] < MIN_FACE_RESOLUTION or face_region['h'] < MIN_FACE_RESOLUTION:
-                logger.info(f"Skipping face due to low resolution: {face_region['w']}x{face_region['h']} (Threshold: {MIN_FACE_RESOLUTION})")
+                logger.info("Skipping face due to low resolution: %sx%s (Threshold: %s)", face_region['w'], face_region['h'], MIN_FACE_RESOLUTION)
                 return False
 
             # 2. Convert image to uint8 format for processing
@@ -271,26 +242,26 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
             elif len(face_image.shape) == 2:
                 gray_face = face_image
             else:
-                logger.warning(f"Skipping face due to unexpected image shape: {face_image.shape}")
+                logger.warning("Skipping face due to unexpected image shape: %s", face_image.shape)
                 return False
 
             # 4. Check Sharpness (Blur)
             sharpness = cv2.Laplacian(gray_face, cv2.CV_64F).var()
             if sharpness < MIN_SHARPNESS:
-                logger.info(f"Skipping face due to blurriness. Sharpness: {sharpness:.2f} (Threshold: {MIN_SHARPNESS})")
+                logger.info("Skipping face due to blurriness. Sharpness: %.2f (Threshold: %s)", sharpness, MIN_SHARPNESS)
                 return False
 
             # 5. Check Brightness
             brightness = np.mean(gray_face)
             if not (MIN_BRIGHTNESS < brightness < MAX_BRIGHTNESS):
-                logger.info(f"Skipping face due to poor brightness: {brightness:.2f} (Range: {MIN_BRIGHTNESS}-{MAX_BRIGHTNESS})")
+                logger.info("Skipping face due to poor brightness: %.2f (Range: %s-%s)", brightness, MIN_BRIGHTNESS, MAX_BRIGHTNESS)
                 return False
             
-            logger.info(f"Face passed quality checks. Resolution: {face_region['w']}x{face_region['h']}, Sharpness: {sharpness:.2f}, Brightness: {brightness:.2f}")
+            logger.info("Face passed quality checks. Resolution: %sx%s, Sharpness: %.2f, Brightness: %.2f", face_region['w'], face_region['h'], sharpness, brightness)
             return True
 
         except Exception as e:
-            logger.error(f"Error during quality assessment: {e}", exc_info=True)
+            logger.exception("Error during quality assessment: %s", e)
             return False
     
     
@@ -327,7 +298,7 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
         for confirmed_box in self.session_confirmed_face_locations:
             iou = self._calculate_iou(face_region, confirmed_box)
             if iou > IOU_THRESHOLD:
-                logger.info(f"Skipping face as it overlaps with a confirmed location. IoU: {iou:.2f}")
+                logger.info("Skipping face as it overlaps with a confirmed location. IoU: %.2f", iou)
                 return True
         return False
         
@@ -363,7 +334,7 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
             return enhanced_img
             
         except Exception as e:
-            logger.warning(f"Error in image preprocessing: {e}")
+            logger.warning("Error in image preprocessing: %s", e)
             return img  # Return original if preprocessing fails
             
     # --- Helper methods ---
@@ -379,55 +350,37 @@ class AttendanceConsumer(AsyncWebsocketConsumer):
             await self.close(code=4000)
 
     @sync_to_async
-    def prepare_face_db_for_deepface(self):
+    def load_face_gallery(self):
         """
-        IMPROVED: Better database preparation with validation.
+        Load the stored face encodings of the course's students, embedding any
+        that are missing, and the names sent back for recognized faces.
+        Returns False if no student can be recognized.
         """
         try:
-            # Clean up existing database
-            if os.path.exists(self.db_path): shutil.rmtree(self.db_path)
-            os.makedirs(self.db_path, exist_ok=True)
-            course = Course.objects.prefetch_related('students').get(id=self.course_id)
-            students = [s for s in course.students.all() if s.profile_photo]
-            if not students: return False
-            for student in students:
-                source_path = student.profile_photo.path
-                if os.path.exists(source_path):
-                    _, ext = os.path.splitext(source_path)
-                    shutil.copy(source_path, os.path.join(self.db_path, f"student_{student.id}{ext}"))
-            if not os.listdir(self.db_path): return False
-            first_image_path = os.path.join(self.db_path, os.listdir(self.db_path)[0])
-            DeepFace.find(img_path=first_image_path, db_path=self.db_path, model_name=MODEL_NAME, enforce_detection=False, silent=True)
-            if not any(f.endswith('.pkl') for f in os.listdir(self.db_path)): return False
-            return True
+            self.teacher_id = Course.objects.values_list('teacher_id', flat=True).get(id=self.course_id)
+            students = list(
+                Student.objects.filter(courses__id=self.course_id)
+                .exclude(profile_photo='').exclude(profile_photo__isnull=True)
+                .values_list('id', 'first_name', 'last_name', 'profile_photo')
+            )
+            self.face_gallery, _ = course_face_gallery([(student_id, photo) for student_id, _, _, photo in students])
+            self.student_names = {
+                student_id: f"{first_name} {last_name}".strip()
+                for student_id, first_name, last_name, _ in students
+            }
+            return len(self.face_gallery) > 0
         except Exception as e:
-            logger.error(f"Failed to prepare face database for course {self.course_id}: {e}", exc_info=True)
+            logger.exception("Failed to load face gallery for course %s: %s", self.course_id, e)
             return False
 
     @sync_to_async
-    def cleanup_resources(self):
-        """Clean up temporary resources."""
+    def mark_students_present(self, student_ids):
+        """Mark students as present in attendance records."""
         try:
-            if hasattr(self, 'db_path') and self.db_path and os.path.exists(self.db_path):
-                shutil.rmtree(self.db_path)
-                logger.info(f"Cleaned up face database: {self.db_path}")
-        except Exception as e:
-            logger.warning(f"Error cleaning up resources: {e}")
-
-    @staticmethod
-    @sync_to_async
-    def mark_student_present(student_id: int, course_id: int):
-        """Mark student as present in attendance record.""" 
-        try:
-            _, created = AttendanceRecord.objects.get_or_create(
-            student_id=student_id, 
-            course_id=course_id, 
-            timestamp__date=timezone.now().date(), 
-            defaults={'timestamp': timezone.now(), 'is_present': True}
-            )
-            if created:
-                logger.info(f"Marked student {student_id} present for course {course_id}")
-            return created
+            marked = mark_students_present(self.course_id, self.teacher_id, student_ids)
+            if marked:
+                logger.info("Marked students %s present for course %s", marked, self.course_id)
+            return marked
         except Exception as e:
-            logger.error(f"Error marking student {student_id} present: {e}")
-            return False
\ No newline at end of file
+            logger.error("Error marking students %s present: %s", student_ids, e)
+            return []
@@ -14,9 +14,9 @@ def custom_exception_handler(exc, context):
     if response is None:
         # Log the full exception traceback for debugging.
         # This is crucial for developers to see what went wrong.
-        logger.error(
-            f"Unhandled exception: {exc}",
-            exc_info=True,
+        logger.exception(
+            "Unhandled exception: %s",
+            exc,
             extra={
                 'request': context['request'].__str__(),
             }
@@ -1,83 +1,453 @@
+import atexit
+import cv2
+import multiprocessing
 import numpy as np
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from deepface import DeepFace
 import logging
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+MODEL_NAME = 'VGG-Face'
+DETECTOR_BACKEND = 'opencv'
+# Cosine distance under which a face counts as a match
+DISTANCE_THRESHOLD = 0.40
+# Minimum score for a face found by the ONNX detector
+ONNX_DETECTOR_SCORE_THRESHOLD = 0.7
+# Longest edge of the grayscale copy used for the quick Haar face count
+HAAR_MAX_SIDE = 640
+# Stored embeddings are normalized and multiplied by this before rounding to int8
+QUANTIZATION_SCALE = 127.0
+
+# Galleries with at least this many faces are matched in parallel shards
+GALLERY_SHARD_MIN_ROWS = 10_000
+
+_encoding_pool = None
+_match_pool = None
+
+
+@dataclass
+class FaceMatches:
+    """
+    Closest enrolled student for every face found in an image, kept as one
+    array per attribute so filtering is a single boolean mask.
+    """
+    student_ids: np.ndarray  # (faces,)
+    confidences: np.ndarray  # (faces,) 1 - cosine distance
+    bboxes: np.ndarray  # (faces, 4) x, y, w, h
+
+    def __len__(self):
+        return len(self.student_ids)
+
+    def where(self, mask: np.ndarray) -> 'FaceMatches':
+        return FaceMatches(self.student_ids[mask], self.confidences[mask], self.bboxes[mask])
+
+    def rescaled(self, factor: float) -> 'FaceMatches':
+        """Bboxes mapped back to an image `factor` times larger than the one searched."""
+        return FaceMatches(self.student_ids, self.confidences, np.rint(self.bboxes * factor).astype(np.int32))
+
+    def to_list(self) -> List[Dict]:
+        """One response dict per face, converting each array to Python once."""
+        return [
+            {
+                "student_id": student_id,
+                "confidence": confidence,
+                "bbox": dict(zip(('x', 'y', 'w', 'h'), bbox))
+            }
+            for student_id, confidence, bbox in zip(
+                self.student_ids.tolist(), self.confidences.tolist(), self.bboxes.tolist()
+            )
+        ]
+
+
+def _resize_with_pad(face: np.ndarray, height: int, width: int) -> np.ndarray:
+    """
+    Fit a face crop into the model input the way DeepFace's `resize_image`
+    does: scale it keeping its aspect ratio, then pad the rest with zeros.
+    Stretching instead would give embeddings that differ from `represent`'s.
+    """
+    factor = min(height / face.shape[0], width / face.shape[1])
+    face = cv2.resize(face, (int(face.shape[1] * factor), int(face.shape[0] * factor)))
+    pad_h, pad_w = height - face.shape[0], width - face.shape[1]
+    face = np.pad(
+        face,
+        ((pad_h // 2, pad_h - pad_h // 2), (pad_w // 2, pad_w - pad_w // 2), (0, 0)),
+        'constant'
+    )
+    if face.shape[:2] != (height, width):
+        face = cv2.resize(face, (width, height))
+    return face
+
+
+def _l2_normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def quantize_embedding(vector, scale: float = QUANTIZATION_SCALE) -> bytes:
+    """L2-normalize an embedding and pack it as int8 bytes for FaceEncoding."""
+    normalized = _l2_normalize(np.asarray(vector, dtype=np.float32))
+    return np.round(normalized * scale).astype(np.int8).tobytes()
+
+
+class FaceGallery:
+    """
+    Known face encodings stacked into one L2-normalized (students x dims)
+    matrix, so a probe is compared to every student with a single product.
+    """
+
+    def __init__(self, student_ids: List[int], encodings: List[np.ndarray]):
+        self.student_ids = np.asarray(student_ids)
+        self.matrix = _l2_normalize(np.asarray(encodings, dtype=np.float32)) if encodings else np.empty((0, 0), dtype=np.float32)
+
+    @classmethod
+    def from_dict(cls, known_faces: Dict) -> 'FaceGallery':
+        return cls(list(known_faces.keys()), list(known_faces.values()))
+
+    @classmethod
+    def from_quantized(cls, rows: List[Tuple[int, bytes, float]]) -> 'FaceGallery':
+        """
+        Build a gallery from stored (student_id, int8 bytes, scale) rows.
+        The int8 matrix is widened to float32 once here so matching keeps
+        using the BLAS matmul.
+        """
+        gallery = cls([student_id for student_id, _, _ in rows], [])
+        if rows:
+            quantized = np.frombuffer(b''.join(bytes(blob) for _, blob, _ in rows), dtype=np.int8).reshape(len(rows), -1)
+            scales = np.array([scale for _, _, scale in rows], dtype=np.float32)
+            gallery.matrix = quantized.astype(np.float32) / scales[:, None]
+        return gallery
+
+    def __len__(self):
+        return len(self.student_ids)
+
+    def pack(self) -> Tuple[bytes, bytes, int]:
+        """
+        Raw int64 ids and the matrix quantized to int8, for sharing through the
+        cache. Rows are unit length, so one scale fits them all and the blob is
+        a quarter of the float32 size.
+        """
+        dims = self.matrix.shape[1] if len(self) else 0
+        quantized = np.round(self.matrix * QUANTIZATION_SCALE).astype(np.int8)
+        return self.student_ids.astype(np.int64).tobytes(), quantized.tobytes(), dims
+
+    @classmethod
+    def unpack(cls, packed: Tuple[bytes, bytes, int]) -> 'FaceGallery':
+        ids_bytes, matrix_bytes, dims = packed
+        gallery = cls([], [])
+        gallery.student_ids = np.frombuffer(ids_bytes, dtype=np.int64)
+        if dims:
+            # Widened back to float32 once, so matching keeps using the BLAS matmul
+            gallery.matrix = np.frombuffer(matrix_bytes, dtype=np.int8).reshape(-1, dims).astype(np.float32) / QUANTIZATION_SCALE
+        return gallery
+
+    def subset(self, student_ids) -> 'FaceGallery':
+        """Gallery restricted to the given students, keeping this gallery's order."""
+        mask = np.isin(self.student_ids, list(student_ids))
+        gallery = FaceGallery([], [])
+        gallery.student_ids = self.student_ids[mask]
+        gallery.matrix = self.matrix[mask]
+        return gallery
+
+    def distances(self, probes: np.ndarray) -> np.ndarray:
+        """Cosine distances of normalized probes to every known face, shape (probes, students)."""
+        if len(self) < GALLERY_SHARD_MIN_ROWS:
+            return 1.0 - probes @ self.matrix.T
+        # numpy releases the GIL in matmul, so the shards run in parallel
+        shards = np.array_split(self.matrix, os.cpu_count())
+        similarities = _get_match_pool().map(lambda shard: probes @ shard.T, shards)
+        return 1.0 - np.concatenate(list(similarities), axis=1)
+
+
 class FaceRecognitionService:
     """
     Service for extracting and matching face encodings.
+
+    The recognition model and the face detector are built once per process
+    and reused by every call, instead of being resolved by DeepFace on each
+    request.
     """
 
+    def __init__(self):
+        self._model = None
+        # Optional ONNX face detector (YuNet) run through OpenCV DNN
+        self.detector_model_path = None
+        self._onnx_detector = None
+        self._onnx_detector_lock = threading.Lock()
+        # Optional ONNX export of the recognition model, run through ONNX Runtime
+        self.embedder_model_path = None
+        self._onnx_embedder = None
+        # Processes embedding profile photos; each holds its own copy of the model
+        self.encoding_workers = 1
+        self._haar_cascade = None
+
+    @property
+    def model(self):
+        """The recognition model, built on first use."""
+        if self._model is None:
+            self._model = DeepFace.build_model(MODEL_NAME)
+            logger.info("Loaded face recognition model %s", MODEL_NAME)
+        return self._model
+
+    def warm_up(self):
+        """
+        Build the recognition model and the face detector up front so the
+        first request does not pay for loading the weights.
+        """
+        if self.embedder_model_path:
+            self.onnx_embedder
+        else:
+            self.model
+        if self.detector_model_path:
+            self.onnx_detector
+        else:
+            DeepFace.build_model(DETECTOR_BACKEND, task="face_detector")
+            logger.info("Loaded face detector %s", DETECTOR_BACKEND)
+
+    @property
+    def onnx_detector(self):
+        """OpenCV DNN face detector for `detector_model_path`, built on first use."""
+        if self._onnx_detector is None:
+            self._onnx_detector = cv2.FaceDetectorYN.create(
+                self.detector_model_path,
+                "",
+                (320, 320),
+                score_threshold=ONNX_DETECTOR_SCORE_THRESHOLD,
+                backend_id=cv2.dnn.DNN_BACKEND_OPENCV,
+                target_id=cv2.dnn.DNN_TARGET_CPU
+            )
+            logger.info("Loaded ONNX face detector %s", self.detector_model_path)
+        return self._onnx_detector
+
+    @property
+    def onnx_embedder(self):
+        """
+        ONNX Runtime session for `embedder_model_path`, built on first use and
+        shared by every request. onnxruntime is only needed when it is set.
+        """
+        if self._onnx_embedder is None:
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            # Leave cores for the detector and the other request threads
+            options.intra_op_num_threads = max(1, (os.cpu_count() or 2) // 2)
+            available = ort.get_available_providers()
+            providers = [p for p in ('CUDAExecutionProvider', 'CPUExecutionProvider') if p in available]
+            self._onnx_embedder = ort.InferenceSession(self.embedder_model_path, sess_options=options, providers=providers)
+            logger.info("Loaded ONNX face embedder %s (%s)", self.embedder_model_path, ', '.join(providers))
+        return self._onnx_embedder
+
+    def _detect_faces_onnx(self, img, enforce_detection: bool = False) -> List[Dict]:
+        """
+        Detect faces with the ONNX detector and return them in the same shape as
+        DeepFace's `extract_faces`: RGB float crops plus their facial area.
+        """
+        if isinstance(img, str):
+            img = cv2.imread(img)
+        height, width = img.shape[:2]
+
+        with self._onnx_detector_lock:
+            self.onnx_detector.setInputSize((width, height))
+            _, detections = self.onnx_detector.detect(img)
+
+        face_objs = []
+        for detection in detections if detections is not None else []:
+            x, y, w, h = (int(v) for v in detection[:4])
+            x, y = max(x, 0), max(y, 0)
+            crop = img[y:y + h, x:x + w]
+            if crop.size == 0:
+                continue
+            face_objs.append({
+                "face": crop[:, :, ::-1].astype(np.float32) / 255.0,
+                "facial_area": {"x": x, "y": y, "w": w, "h": h},
+                "confidence": float(detection[-1])
+            })
+
+        if enforce_detection and not face_objs:
+            raise ValueError("Face could not be detected in the image.")
+        return face_objs
+
+    def _detect_faces(self, img, enforce_detection: bool = False) -> List[Dict]:
+        """Run the cached detector and return DeepFace's face objects."""
+        if self.detector_model_path:
+            return self._detect_faces_onnx(img, enforce_detection)
+        return DeepFace.extract_faces(
+            img_path=img,
+            detector_backend=DETECTOR_BACKEND,
+            enforce_detection=enforce_detection,
+            align=True
+        )
+
+    def _embed_faces(self, faces: List[np.ndarray]) -> np.ndarray:
+        """
+        Embed detected face crops with the cached model.
+        Crops come from `extract_faces` as RGB floats in [0, 1].
+        """
+        if self.embedder_model_path:
+            # The export keeps the model's NHWC input: (batch, height, width, 3)
+            model_input = self.onnx_embedder.get_inputs()[0]
+            height, width = model_input.shape[1:3]
+        else:
+            # DeepFace gives the input size as (width, height)
+            width, height = self.model.input_shape
+        batch = np.stack([
+            _resize_with_pad(face[:, :, ::-1], height, width) for face in faces
+        ]).astype(np.float32)
+        if self.embedder_model_path:
+            embeddings = self.onnx_embedder.run(None, {model_input.name: batch})[0]
+        else:
+            # The Keras model itself, since DeepFace's `forward` only returns
+            # the first row of a batch in some releases
+            embeddings = self.model.model(batch, training=False).numpy()
+        return np.asarray(embeddings, dtype=np.float32).reshape(len(faces), -1)
+
     def extract_face_encodings(self, image_path: str) -> Optional[np.ndarray]:
         """
         Extract face embeddings using DeepFace for a given image path.
         Returns the vector or None if detection fails.
         """
         try:
-            embedding_obj = DeepFace.represent(
-                img_path=image_path,
-                model_name='VGG-Face',
-                enforce_detection=False
-            )
-            if embedding_obj and isinstance(embedding_obj, list):
-                return embedding_obj[0]["embedding"]
+            face_objs = self._detect_faces(image_path)
+            if face_objs:
+                return self._embed_faces([face_objs[0]["face"]])[0]
         except Exception as e:
-            logger.error(f"Failed to extract face encoding from {image_path}: {e}")
+            logger.error("Failed to extract face encoding from %s: %s", image_path, e)
         return None
 
-    def find_faces_in_image(self, test_image_path: str, known_faces: Dict[str, List[float]]) -> List[Dict[str, str]]:
+    def prepare_student_face_database(self, students_data: List[Dict]) -> FaceGallery:
+        """
+        Embed every student's profile photo, on the encoding pool when more
+        than one worker is configured and in this process otherwise.
+        Returns the encodings as a FaceGallery; students whose photo has no
+        detectable face are left out.
         """
-        Compare test image to known faces using DeepFace verify.
+        paths = [student['profile_photo_path'] for student in students_data]
+        if self.encoding_workers > 1:
+            encodings = _get_encoding_pool().map(extract_face_encodings, paths, chunksize=4)
+        else:
+            # A single spawned worker would only load a second copy of the model
+            encodings = map(self.extract_face_encodings, paths)
+
+        student_ids, known_encodings = [], []
+        for student, encoding in zip(students_data, encodings):
+            if encoding is None:
+                logger.warning("No face encoding for student %s", student['id'])
+                continue
+            student_ids.append(student['id'])
+            known_encodings.append(encoding)
+        return FaceGallery(student_ids, known_encodings)
+
+    def _match_faces(self, image, known_faces) -> Tuple[List[Dict], np.ndarray, np.ndarray]:
+        """
+        Detect every face in the image once, embed them in a single batch and
+        compare them to all known faces with one matrix product.
+        `known_faces` is a FaceGallery or a mapping of student id to encoding.
+        Returns the detected faces, the closest student id for each face and
+        the cosine distance to that student.
+        """
+        gallery = known_faces if isinstance(known_faces, FaceGallery) else FaceGallery.from_dict(known_faces)
+        face_objs = self._detect_faces(image)
+        if not face_objs or not len(gallery):
+            return [], np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        student_ids, distances = self.match_face_crops([face_obj["face"] for face_obj in face_objs], gallery)
+        return face_objs, student_ids, distances
+
+    def match_face_crops(self, faces: List[np.ndarray], gallery: FaceGallery) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Embed face crops the caller already detected (RGB floats in [0, 1], as
+        from `extract_faces`) in one batch and compare them to the gallery.
+        Returns the closest student id for each crop and its cosine distance.
+        """
+        probes = _l2_normalize(self._embed_faces(faces))
+        distances = gallery.distances(probes)
+        best = distances.argmin(axis=1)
+        return gallery.student_ids[best], distances[np.arange(len(faces)), best]
+
+    def find_faces_in_image(self, test_image_path: str, known_faces) -> List[Dict[str, str]]:
+        """
+        Compare the faces in the test image to known faces.
         Returns list of matches.
         """
-        results = []
-        for student_id, encoding in known_faces.items():
-            try:
-                verification_result = DeepFace.verify(
-                    img1_path=test_image_path,
-                    img2_path=None,  # Use embedding instead
-                    model_name='VGG-Face',
-                    distance_metric='cosine',
-                    enforce_detection=False,
-                    img2_representation=encoding
-                )
-
-                if verification_result.get('verified'):
-                    results.append({
-                        "student_id": student_id,
-                        "distance": verification_result.get('distance'),
-                        "model": verification_result.get('model'),
-                        "threshold": verification_result.get('threshold')
-                    })
-            except Exception as e:
-                logger.warning(f"Verification failed for student {student_id}: {e}")
-        return results
-
-    def validate_face_image(self, image_path):
-        """
-        Validates if a single, clear face is present in the image.
+        try:
+            _, student_ids, distances = self._match_faces(test_image_path, known_faces)
+        except Exception as e:
+            logger.warning("Face matching failed for %s: %s", test_image_path, e)
+            return []
+
+        matched = np.where(distances < DISTANCE_THRESHOLD)[0]
+        return [
+            {
+                "student_id": student_ids[i].item(),
+                "distance": float(distances[i]),
+                "model": MODEL_NAME,
+                "threshold": DISTANCE_THRESHOLD
+            }
+            for i in matched
+        ]
+
+    def find_faces_in_image_enhanced(self, test_image, known_faces) -> FaceMatches:
+        """
+        Returns the closest enrolled student for every face detected in the
+        test image, with a confidence of 1 - cosine distance and its bbox.
+        """
+        face_objs, student_ids, distances = self._match_faces(test_image, known_faces)
+        bboxes = np.array(
+            [[face_obj["facial_area"][key] for key in ('x', 'y', 'w', 'h')] for face_obj in face_objs],
+            dtype=np.int32
+        ).reshape(-1, 4)
+        return FaceMatches(student_ids, (1.0 - distances).astype(np.float32), bboxes)
+
+    def _count_faces_haar(self, image) -> Optional[int]:
+        """
+        Cheap face count with OpenCV's Haar cascade on a small grayscale copy.
+        `image` is a file path or a decoded BGR array.
+        Returns None if the image cannot be read.
+        """
+        if self._haar_cascade is None:
+            self._haar_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        if isinstance(image, np.ndarray):
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            return None
+        scale = HAAR_MAX_SIDE / max(gray.shape[:2])
+        if scale < 1:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return len(self._haar_cascade.detectMultiScale(gray, scaleFactor=1.2, minNeighbors=5))
+
+    def validate_face_image(self, image):
+        """
+        Validates if a single, clear face is present in the image, given as a
+        file path or a decoded BGR array.
         """
+        # Reject uploads with no or several faces before running the full
+        # detector and the recognition model.
+        haar_count = self._count_faces_haar(image)
+        if haar_count == 0:
+            return {"valid": False, "error": "No face detected in the image."}
+        if haar_count and haar_count > 1:
+            return {"valid": False, "error": "Multiple faces detected in the image.", "face_count": haar_count}
+
         try:
-            # The `represent` function with `enforce_detection=True` will raise an exception
-            # if no face is detected or if multiple faces are detected.
-            face_objs = DeepFace.represent(
-                img_path=image_path,
-                model_name='VGG-Face',
-                enforce_detection=True  # Strict validation
-            )
-            
-            # The result should be a list containing one dictionary
+            # `extract_faces` with `enforce_detection=True` will raise an exception
+            # if no face is detected.
+            face_objs = self._detect_faces(image, enforce_detection=True)
+
+            # The result should be a list containing one face
             if isinstance(face_objs, list) and len(face_objs) == 1:
                 return {
                     "valid": True,
                     "message": "A single clear face was detected.",
                     "face_count": 1,
-                    "embedding": face_objs[0]['embedding']
+                    "embedding": self._embed_faces([face_objs[0]["face"]])[0].tolist()
                 }
             else:
-                # This case might be redundant due to enforce_detection=True, but it's good for safety
                 return {
                     "valid": False,
                     "error": "Multiple faces detected.",
@@ -94,7 +464,54 @@ class FaceRecognitionService:
             else:
                 return {"valid": False, "error": f"An unexpected validation error occurred: {e}"}
         except Exception as e:
-            logger.error(f"Error during face validation for {image_path}: {e}")
+            source = image if isinstance(image, str) else "in-memory image"
+            logger.error("Error during face validation for %s: %s", source, e)
             return {"valid": False, "error": "An internal error occurred during face validation."}
-            
-face_recognition_service = FaceRecognitionService()
\ No newline at end of file
+
+face_recognition_service = FaceRecognitionService()
+
+
+def extract_face_encodings(image_path: str) -> Optional[np.ndarray]:
+    """Module-level wrapper so encoding jobs can be sent to the process pool."""
+    return face_recognition_service.extract_face_encodings(image_path)
+
+
+def _init_encoding_worker(detector_model_path, embedder_model_path):
+    face_recognition_service.detector_model_path = detector_model_path
+    face_recognition_service.embedder_model_path = embedder_model_path
+    face_recognition_service.warm_up()
+
+
+def _get_encoding_pool() -> ProcessPoolExecutor:
+    """
+    Shared pool of encoding workers, created on first use.
+    Workers are spawned rather than forked, since TensorFlow state does not
+    survive a fork, and each builds the model once in its initializer, so
+    the pool is capped at `encoding_workers` to bound memory.
+    """
+    global _encoding_pool
+    if _encoding_pool is None:
+        _encoding_pool = ProcessPoolExecutor(
+            max_workers=face_recognition_service.encoding_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_encoding_worker,
+            initargs=(face_recognition_service.detector_model_path, face_recognition_service.embedder_model_path)
+        )
+        atexit.register(_shutdown_encoding_pool)
+    return _encoding_pool
+
+
+def _shutdown_encoding_pool():
+    """Stop the encoding workers when the process exits."""
+    global _encoding_pool
+    if _encoding_pool is not None:
+        _encoding_pool.shutdown(wait=True, cancel_futures=True)
+        _encoding_pool = None
+
+
+def _get_match_pool() -> ThreadPoolExecutor:
+    """Threads for matching large galleries shard by shard, created on first use."""
+    global _match_pool
+    if _match_pool is None:
+        _match_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='face-match')
+    return _match_pool
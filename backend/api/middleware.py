@@ -1,5 +1,10 @@
 # facials/backend/api/middleware.py
 
+import hashlib
+import threading
+import time
+
+from cachetools import TTLCache
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.tokens import AccessToken
@@ -7,20 +12,62 @@ from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from urllib.parse import parse_qs
 from channels.middleware import BaseMiddleware
 from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 User = get_user_model()
 
+# Users resolved from access tokens, keyed by a hash of the token. Entries
+# never outlive the token's own expiry, and a user's entries are dropped when
+# the user is saved (e.g. deactivated) or deleted; other processes catch up
+# within TOKEN_CACHE_TTL. TTLCache is not thread-safe, so access is locked.
+TOKEN_CACHE_TTL = 60
+_token_user_cache = TTLCache(maxsize=4096, ttl=TOKEN_CACHE_TTL)
+_token_user_cache_lock = threading.Lock()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def evict_cached_token_user(sender, instance, **kwargs):
+    with _token_user_cache_lock:
+        stale_keys = [key for key, (user, _) in list(_token_user_cache.items()) if user.pk == instance.pk]
+        for key in stale_keys:
+            _token_user_cache.pop(key, None)
+
+
 @database_sync_to_async
-def get_user(token_key):
+def _get_user_from_token(token_key):
     try:
         # Validate the token
         token = AccessToken(token_key)
         # Get the user ID from the token
         user_id = token.payload['user_id']
-        return User.objects.get(id=user_id)
+        # Only the fields needed to authorize the connection; others load lazily if touched
+        user = User.objects.only('id', 'email', 'is_active', 'is_staff', 'is_superuser').get(id=user_id)
+        if not user.is_active:
+            # Deactivated users are refused, as by the REST API's JWT authentication
+            return AnonymousUser(), None
+        return user, token.payload['exp']
     except (InvalidToken, TokenError, User.DoesNotExist):
         # Token is invalid or user doesn't exist
-        return AnonymousUser()
+        return AnonymousUser(), None
+
+async def get_user(token_key):
+    cache_key = hashlib.blake2b(token_key.encode(), digest_size=16).digest()
+    with _token_user_cache_lock:
+        cached = _token_user_cache.get(cache_key)
+        if cached is not None:
+            user, expires_at = cached
+            if expires_at > time.time():
+                return user
+            _token_user_cache.pop(cache_key, None)
+
+    user, expires_at = await _get_user_from_token(token_key)
+    # Only verified tokens are cached; invalid ones are checked again every time
+    if expires_at is not None:
+        with _token_user_cache_lock:
+            _token_user_cache[cache_key] = (user, expires_at)
+    return user
 
 class TokenAuthMiddleware(BaseMiddleware):
     """
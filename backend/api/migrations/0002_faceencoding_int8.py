@@ -0,0 +1,38 @@
+# Generated by Django 4.2.23 on 2026-10-16 09:00
+
+from django.db import migrations, models
+
+
+def delete_text_encodings(apps, schema_editor):
+    # Rows would otherwise be left with an empty blob, which FaceGallery
+    # cannot read; students without a row are re-embedded on demand.
+    FaceEncoding = apps.get_model("api", "FaceEncoding")
+    FaceEncoding.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0001_initial"),
+    ]
+
+    operations = [
+        # Text encodings cannot be converted to the int8 layout; they are
+        # recomputed from the profile photos the next time they are needed.
+        migrations.RunPython(delete_text_encodings, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="faceencoding",
+            name="encoding",
+        ),
+        migrations.AddField(
+            model_name="faceencoding",
+            name="encoding",
+            field=models.BinaryField(default=b""),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="faceencoding",
+            name="scale",
+            field=models.FloatField(default=127.0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.23 on 2026-10-16 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0002_faceencoding_int8"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="attendancerecord",
+            index=models.Index(
+                fields=["course", "timestamp"], name="att_course_ts_idx"
+            ),
+        ),
+    ]
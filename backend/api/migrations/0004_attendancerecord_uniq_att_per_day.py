@@ -0,0 +1,55 @@
+# Generated by Django 4.2.23 on 2026-10-16 10:05
+
+import logging
+
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+logger = logging.getLogger(__name__)
+
+
+def remove_duplicate_attendance(apps, schema_editor):
+    # Keep one record per student, course and day so the constraint can be
+    # created on existing data: the earliest "present" one if there is any,
+    # otherwise the earliest. The dashboard counts one record per student
+    # and day, so its totals only lose the duplicates.
+    AttendanceRecord = apps.get_model("api", "AttendanceRecord")
+    seen = set()
+    duplicate_ids = []
+    rows = (
+        AttendanceRecord.objects.annotate(day=TruncDate("timestamp"))
+        .order_by("-is_present", "timestamp", "id")
+        .values_list("id", "student_id", "course_id", "day")
+    )
+    for record_id, student_id, course_id, day in rows.iterator():
+        key = (student_id, course_id, day)
+        if key in seen:
+            duplicate_ids.append(record_id)
+        else:
+            seen.add(key)
+    if duplicate_ids:
+        AttendanceRecord.objects.filter(id__in=duplicate_ids).delete()
+        logger.warning(
+            "Removed %s duplicate attendance records (same student, course and day) before adding uniq_att_per_day",
+            len(duplicate_ids)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0003_attendancerecord_att_course_ts_idx"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_attendance, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="attendancerecord",
+            constraint=models.UniqueConstraint(
+                models.F("student"),
+                models.F("course"),
+                TruncDate("timestamp"),
+                name="uniq_att_per_day",
+            ),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.23 on 2026-10-16 10:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+
+def backfill_daily_attendance(apps, schema_editor):
+    AttendanceRecord = apps.get_model("api", "AttendanceRecord")
+    DailyAttendanceCount = apps.get_model("api", "DailyAttendanceCount")
+    rows = (
+        AttendanceRecord.objects.annotate(day=TruncDate("timestamp"))
+        .values("course_id", "day")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    DailyAttendanceCount.objects.bulk_create(
+        [
+            DailyAttendanceCount(course_id=row["course_id"], day=row["day"], count=row["count"])
+            for row in rows.iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0004_attendancerecord_uniq_att_per_day"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyAttendanceCount",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "course",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="daily_attendance_counts",
+                        to="api.course",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="dailyattendancecount",
+            constraint=models.UniqueConstraint(
+                fields=("course", "day"), name="uniq_daily_attendance"
+            ),
+        ),
+        migrations.RunPython(backfill_daily_attendance, migrations.RunPython.noop),
+    ]
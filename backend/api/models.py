@@ -1,6 +1,11 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser, BaseUserManager, PermissionsMixin
 from django.conf import settings # Needed for User foreign key if not using get_user_model
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.functions import TruncDate
+from django.db.models.signals import m2m_changed, post_init, post_save, post_delete, pre_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _ # Good practice for field names
 from .managers import CustomUserManager
@@ -95,14 +100,25 @@ class Student(models.Model):
     def __str__(self):
         return f"{self.first_name} {self.last_name} ({self.student_id})"
 
+    @property
+    def has_face_enrolled(self):
+        # Reads the stored file name directly instead of building a FieldFile through the descriptor
+        try:
+            return bool(self.__dict__['profile_photo'])
+        except KeyError:
+            # The column was deferred; let Django load it
+            return bool(self.profile_photo)
+
 # SESSION: FACE RECOGNITION DATA
 class FaceEncoding(models.Model):
     # This is the core of the face recognition system.
     # We store a mathematical representation (encoding) of a student's face.
     # Each student has a unique face encoding. OneToOneField ensures this.
     student = models.OneToOneField(Student, on_delete=models.CASCADE, related_name='face_encoding')
-    # The encoding is a list of 128 numbers. We store it as a text field.
-    encoding = models.TextField()
+    # The encoding is the L2-normalized embedding quantized to int8, stored as raw bytes.
+    encoding = models.BinaryField()
+    # The factor the embedding was multiplied by before rounding to int8.
+    scale = models.FloatField(default=127.0)
     # Timestamp for when the encoding was created or last updated.
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -122,11 +138,147 @@ class AttendanceRecord(models.Model):
     class Meta:
         # Ensures a student can only be marked once for a specific course on a specific day.
         unique_together = ('student', 'course', 'timestamp')
+        indexes = [
+            # Per-course, per-day lookups (reports, the dashboard) range-scan this index.
+            models.Index(fields=['course', 'timestamp'], name='att_course_ts_idx'),
+        ]
+        constraints = [
+            # One record per student, course and day, so concurrent attendance
+            # runs cannot both mark the same student.
+            models.UniqueConstraint(
+                models.F('student'), models.F('course'), TruncDate('timestamp'),
+                name='uniq_att_per_day'
+            ),
+        ]
 
     def __str__(self):
         return f"{self.student} in {self.course} at {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
     
-    # --- Cache Invalidation Signals ---
+
+class DailyAttendanceCount(models.Model):
+    # Attendance records per course and local day, kept up to date by the
+    # AttendanceRecord signals so the dashboard chart sums a few rows instead
+    # of grouping the raw records.
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='daily_attendance_counts')
+    day = models.DateField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['course', 'day'], name='uniq_daily_attendance'),
+        ]
+
+    def __str__(self):
+        return f"{self.course} on {self.day}: {self.count}"
+
+
+def add_daily_attendance(course_id, day, delta):
+    """Add `delta` records to a course's count for `day`, creating the row if needed."""
+    rows = DailyAttendanceCount.objects.filter(course_id=course_id, day=day)
+    if rows.update(count=F('count') + delta) or delta <= 0:
+        return
+    _, created = DailyAttendanceCount.objects.get_or_create(course_id=course_id, day=day, defaults={'count': delta})
+    if not created:
+        # Another request created the row first
+        rows.update(count=F('count') + delta)
+
+
+# --- Cache Invalidation Signals ---
 # These functions are defined at the module level, NOT inside a class.
 
-   
\ No newline at end of file
+def dashboard_chart_cache_key(teacher_id):
+    return f"dashboard:chart:{teacher_id}"
+
+
+def dashboard_cache_key(teacher_id):
+    return f"dashboard:{teacher_id}"
+
+
+def invalidate_teacher_dashboard(teacher_id):
+    cache.delete_many([dashboard_cache_key(teacher_id), dashboard_chart_cache_key(teacher_id)])
+
+
+@receiver([post_save, post_delete], sender=AttendanceRecord)
+def invalidate_dashboard_for_attendance(sender, instance, **kwargs):
+    # Look up the teacher id directly so the signal does not load the full course row.
+    teacher_id = Course.objects.filter(id=instance.course_id).values_list('teacher_id', flat=True).first()
+    if teacher_id is not None:
+        invalidate_teacher_dashboard(teacher_id)
+
+
+@receiver(post_save, sender=AttendanceRecord)
+def count_daily_attendance(sender, instance, created, **kwargs):
+    if created:
+        add_daily_attendance(instance.course_id, timezone.localdate(instance.timestamp), 1)
+
+
+@receiver(post_delete, sender=AttendanceRecord)
+def uncount_daily_attendance(sender, instance, **kwargs):
+    add_daily_attendance(instance.course_id, timezone.localdate(instance.timestamp), -1)
+
+
+@receiver([post_save, post_delete], sender=Course)
+def invalidate_dashboard_for_course(sender, instance, **kwargs):
+    invalidate_teacher_dashboard(instance.teacher_id)
+
+
+@receiver(m2m_changed, sender=Student.courses.through)
+def invalidate_dashboard_for_enrollment(sender, instance, action, reverse, pk_set, **kwargs):
+    # Enrollment changes the dashboard's student counts
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # instance is the course
+        invalidate_teacher_dashboard(instance.teacher_id)
+        return
+    courses = Course.objects.filter(id__in=pk_set) if pk_set else instance.courses.all()
+    for teacher_id in set(courses.values_list('teacher_id', flat=True)):
+        invalidate_teacher_dashboard(teacher_id)
+   
+
+FACE_GALLERY_VERSION_KEY = "face_gallery:version"
+
+
+def bump_face_gallery_version():
+    # Shared through the cache so every web and worker process sees the change.
+    try:
+        cache.incr(FACE_GALLERY_VERSION_KEY)
+    except ValueError:
+        cache.set(FACE_GALLERY_VERSION_KEY, 1, None)
+
+
+@receiver([post_save, post_delete], sender=FaceEncoding)
+def invalidate_face_gallery(sender, instance, **kwargs):
+    bump_face_gallery_version()
+
+
+def _stored_photo_name(instance):
+    # None when the photo column was deferred and never loaded
+    if 'profile_photo' not in instance.__dict__:
+        return None
+    photo = instance.__dict__['profile_photo']
+    return getattr(photo, 'name', photo) or ''
+
+
+@receiver([post_init, post_save], sender=Student)
+def remember_profile_photo(sender, instance, **kwargs):
+    # The photo name as it is in the database, so pre_save can tell whether
+    # it changed without reading the row again
+    instance._stored_profile_photo = _stored_photo_name(instance)
+    instance.__dict__.pop('_face_encoding_updated', None)
+
+
+@receiver(pre_save, sender=Student)
+def drop_stale_face_encoding(sender, instance, update_fields=None, **kwargs):
+    # A stored encoding belongs to the photo it was computed from; when the photo
+    # changes the encoding is dropped and rebuilt on the next attendance run.
+    # Callers that write the new encoding themselves set _face_encoding_updated.
+    if instance.pk is None or getattr(instance, '_face_encoding_updated', False):
+        return
+    if update_fields is not None and 'profile_photo' not in update_fields:
+        return
+    old_photo = instance._stored_profile_photo
+    if old_photo is None:
+        old_photo = Student.objects.filter(pk=instance.pk).values_list('profile_photo', flat=True).first()
+    if old_photo is not None and old_photo != (instance.profile_photo.name or ''):
+        FaceEncoding.objects.filter(student_id=instance.pk).delete()
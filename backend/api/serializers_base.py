@@ -0,0 +1,59 @@
+# api/serializers_base.py
+import copy
+
+from django.utils.functional import cached_property
+from rest_framework import serializers
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+
+
+class CachedModelSerializer(serializers.ModelSerializer):
+    """
+    ModelSerializer that builds its field declarations once per class.
+
+    ModelSerializer.get_fields introspects the model and constructs every
+    field on each instantiation, which dominates list endpoints. The built
+    fields are kept per class and each instance gets its own copies to bind.
+    """
+    _fields_cache = {}
+
+    def get_fields(self):
+        cls = type(self)
+        fields = self._fields_cache.get(cls)
+        if fields is None:
+            fields = self._fields_cache[cls] = super().get_fields()
+        return {name: self._copy_field(field) for name, field in fields.items()}
+
+    @cached_property
+    def _readable_field_list(self):
+        # A list child serializer renders every row with the same fields
+        return list(self._readable_fields)
+
+    def to_representation(self, instance):
+        """
+        Same as Serializer.to_representation, but builds a plain dict rather
+        than an OrderedDict and reuses the readable field list across rows.
+        """
+        ret = {}
+        for field in self._readable_field_list:
+            try:
+                attribute = field.get_attribute(instance)
+            except SkipField:
+                continue
+
+            check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            ret[field.field_name] = None if check_for_none is None else field.to_representation(attribute)
+        return ret
+
+    def __deepcopy__(self, memo):
+        # Rebuild from the constructor arguments without deep-copying them;
+        # serializers never mutate their kwargs, so sharing them is safe.
+        return self.__class__(*self._args, **self._kwargs)
+
+    @staticmethod
+    def _copy_field(field):
+        # Nested serializers and many=True relations hold a child field that
+        # gets bound to its parent, so they need their own child per instance.
+        if isinstance(field, (serializers.BaseSerializer, serializers.ManyRelatedField)):
+            return copy.deepcopy(field)
+        return copy.copy(field)
@@ -1,5 +1,3 @@
 # backend/api/services.py
 
-from .face_recognition_service import FaceRecognitionService
-
-face_recognition_service = FaceRecognitionService()
+from .face_recognition_service import FaceRecognitionService, face_recognition_service
@@ -0,0 +1,309 @@
+# backend/api/tasks.py
+
+import logging
+import os
+
+import cv2
+import numpy as np
+
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from rest_framework import status
+
+from .face_recognition_service import QUANTIZATION_SCALE, FaceGallery, face_recognition_service, quantize_embedding
+from .models import (
+    FACE_GALLERY_VERSION_KEY, Course, Student, AttendanceRecord, FaceEncoding,
+    add_daily_attendance, bump_face_gallery_version, invalidate_teacher_dashboard
+)
+from .serializers import StudentSerializer
+from .utils import remove_file, save_generated_file, unique_name_suffix
+
+logger = logging.getLogger(__name__)
+
+
+# Every stored face encoding, loaded once per process and rebuilt when the
+# shared gallery version changes.
+_face_gallery = {'gallery': None, 'version': None}
+FACE_GALLERY_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+# Images for queued jobs travel through the shared cache (Redis), since the
+# web service and the worker do not share a disk
+JOB_IMAGE_TIMEOUT = 60 * 10
+
+
+def stash_job_image(image_data):
+    """Store an image for a queued job in the shared cache and return its key."""
+    key = f"job_image:{unique_name_suffix()}"
+    cache.set(key, image_data, JOB_IMAGE_TIMEOUT)
+    return key
+
+
+def take_job_image(key):
+    """Image stored by stash_job_image, removed from the cache; None once it expired."""
+    image_data = cache.get(key)
+    cache.delete(key)
+    return image_data
+
+
+def face_gallery_cache_key(version):
+    return f"faces:gallery:i8:v{version}"
+
+
+def get_face_gallery():
+    version = cache.get(FACE_GALLERY_VERSION_KEY, 0)
+    if _face_gallery['gallery'] is None or _face_gallery['version'] != version:
+        # Another process has usually packed this version already; only the
+        # first one to see it reads Postgres.
+        packed = cache.get(face_gallery_cache_key(version))
+        if packed is not None:
+            gallery = FaceGallery.unpack(packed)
+        else:
+            gallery = FaceGallery.from_quantized(
+                list(FaceEncoding.objects.values_list('student_id', 'encoding', 'scale'))
+            )
+            cache.set(face_gallery_cache_key(version), gallery.pack(), FACE_GALLERY_CACHE_TIMEOUT)
+        _face_gallery['gallery'] = gallery
+        _face_gallery['version'] = version
+        logger.info("Loaded face gallery with %s encodings", len(gallery))
+    return _face_gallery['gallery']
+
+
+def course_face_gallery(photos):
+    """
+    Gallery for a course's (student id, profile photo name) pairs. Stored
+    encodings come from the in-process gallery; only students without one
+    have their profile photo embedded, and the new encodings are stored so
+    later requests read them instead of re-embedding.
+    Returns the gallery and how many students had an encoding or a photo on disk.
+    """
+    known_faces_db = get_face_gallery().subset(student_id for student_id, _ in photos)
+    encoded_ids = set(known_faces_db.student_ids.tolist())
+
+    students_data = []
+    for student_id, photo_name in photos:
+        if student_id in encoded_ids:
+            continue
+        photo_path = os.path.join(settings.MEDIA_ROOT, photo_name)
+        if os.path.exists(photo_path):
+            students_data.append({'id': student_id, 'profile_photo_path': photo_path})
+    students_with_photos = len(known_faces_db) + len(students_data)
+
+    if students_data:
+        new_faces = face_recognition_service.prepare_student_face_database(students_data)
+        FaceEncoding.objects.bulk_create(
+            [
+                FaceEncoding(student_id=student_id, encoding=quantize_embedding(encoding), scale=QUANTIZATION_SCALE)
+                for student_id, encoding in zip(new_faces.student_ids.tolist(), new_faces.matrix)
+            ],
+            ignore_conflicts=True
+        )
+        # bulk_create sends no post_save, so invalidate the gallery here
+        bump_face_gallery_version()
+        known_faces_db = get_face_gallery().subset(student_id for student_id, _ in photos)
+    return known_faces_db, students_with_photos
+
+
+def mark_students_present(course_id, teacher_id, student_ids):
+    """
+    Mark the given students present in the course today, with one query for
+    the existing records and one insert for the rest.
+    Returns the ids that were newly marked, in the given order.
+    """
+    now = timezone.now()
+    # timestamp__date compares in the current time zone, like the
+    # uniq_att_per_day constraint and the daily rollup
+    today = timezone.localdate(now)
+    already_marked = set(
+        AttendanceRecord.objects.filter(course_id=course_id, student_id__in=student_ids, timestamp__date=today)
+        .values_list('student_id', flat=True)
+    )
+    new_ids = [student_id for student_id in student_ids if student_id not in already_marked]
+    if not new_ids:
+        return new_ids
+
+    AttendanceRecord.objects.bulk_create(
+        [
+            AttendanceRecord(student_id=student_id, course_id=course_id, timestamp=now, is_present=True)
+            for student_id in new_ids
+        ],
+        ignore_conflicts=True
+    )
+    # Rows skipped by ignore_conflicts (a concurrent frame or request marked
+    # the student first) carry another timestamp, so this finds ours
+    inserted = set(
+        AttendanceRecord.objects.filter(course_id=course_id, student_id__in=new_ids, timestamp=now)
+        .values_list('student_id', flat=True)
+    )
+    new_ids = [student_id for student_id in new_ids if student_id in inserted]
+    if not new_ids:
+        return new_ids
+
+    # bulk_create sends no post_save, so update the daily rollup and
+    # invalidate the dashboard here
+    add_daily_attendance(course_id, today, len(new_ids))
+    invalidate_teacher_dashboard(teacher_id)
+    return new_ids
+
+
+def recognize_attendance(course_id, image, bbox_scale=1.0):
+    """
+    Match the faces in a classroom image (a saved path or a decoded BGR array)
+    against the course's enrolled students and mark the recognized ones present.
+    `bbox_scale` maps the reported bboxes back to the uploaded image's size
+    when a downscaled copy was searched.
+    Returns the response payload and its HTTP status.
+    """
+    course = Course.objects.get(id=course_id)
+
+    # Prepare student data for face database
+    if not course.students.exists():
+        return {
+            "error": "No students enrolled in this course.",
+            "code": "NO_STUDENTS"
+        }, status.HTTP_400_BAD_REQUEST
+
+    # Only the id and photo path are needed to build the face database
+    photos = list(course.students.exclude(profile_photo='').exclude(profile_photo__isnull=True).values_list('id', 'profile_photo'))
+
+    known_faces_db, students_with_photos = course_face_gallery(photos)
+    if not students_with_photos:
+        return {
+            "error": "No students in this course have face encodings. Please upload student photos.",
+            "code": "NO_FACE_DATA"
+        }, status.HTTP_400_BAD_REQUEST
+
+    logger.info("Prepared face database with %s student faces", students_with_photos)
+
+    if not known_faces_db:
+        return {
+            "error": "Failed to prepare face database.",
+            "code": "DATABASE_ERROR"
+        }, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    # Find faces in the classroom image using enhanced service
+    face_matches = face_recognition_service.find_faces_in_image_enhanced(image, known_faces_db)
+    if bbox_scale != 1.0:
+        face_matches = face_matches.rescaled(bbox_scale)
+
+    # Mark attendance: one query for today's existing records and one insert
+    confident = face_matches.where(face_matches.confidences >= 0.7)  # High confidence threshold
+    confidences = {}
+    for student_id, confidence in zip(confident.student_ids.tolist(), confident.confidences.tolist()):
+        confidences.setdefault(student_id, confidence)
+    recognized_student_ids = mark_students_present(course.id, course.teacher_id, confidences)
+    for student_id in recognized_student_ids:
+        logger.info("Marked present: student %s (confidence: %.2f)", student_id, confidences[student_id])
+
+    # Full rows are only needed for the students we report back
+    present_students = Student.objects.in_bulk(recognized_student_ids)
+    present_students_data = [
+        StudentSerializer(present_students[student_id]).data
+        for student_id in recognized_student_ids if student_id in present_students
+    ]
+
+    return {
+        "status": "Attendance marked successfully",
+        "present_students": present_students_data,
+        "recognized_faces_count": len(recognized_student_ids),
+        "total_faces_detected": len(face_matches),
+        "students_with_photos": students_with_photos,
+        "face_matches": face_matches.to_list()
+    }, status.HTTP_200_OK
+
+
+def enroll_student_face(student, image_data, ext, serializer_context=None):
+    """
+    Validate a decoded photo and, if it shows one clear face, store it as the
+    student's profile photo along with its face encoding.
+    Returns the response payload and its HTTP status.
+    """
+    # Validate the decoded image in memory; only an accepted photo is written
+    img = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return {
+            "error": "Invalid image data. Please check the image format.",
+            "code": "DECODE_ERROR"
+        }, status.HTTP_400_BAD_REQUEST
+
+    # Validate face in image
+    validation_result = face_recognition_service.validate_face_image(img)
+    del img
+
+    if not validation_result['valid']:
+        return {
+            "error": f"No clear face detected in image: {validation_result.get('error', 'Unknown error')}",
+            "code": "NO_FACE_DETECTED",
+            "suggestion": "Please upload a clear photo with the student's face visible"
+        }, status.HTTP_400_BAD_REQUEST
+
+    # If validation passed, save the image
+    image_filename = f'student_{student.id}_{unique_name_suffix()}.{ext}'
+
+    old_path = student.profile_photo.path if student.profile_photo else None
+
+    # Write the photo once; only the photo column is updated. The old photo is
+    # removed after the row points at the new one, so a failed write never
+    # leaves the student without a photo on disk.
+    save_generated_file(student.profile_photo, image_filename, image_data)
+    del image_data
+    # The encoding is replaced below, so the save need not drop it first
+    student._face_encoding_updated = True
+    student.save(update_fields=['profile_photo'])
+    if old_path:
+        remove_file(old_path, "old photo")
+
+    # Keep the stored encoding in step with the new photo
+    FaceEncoding.objects.update_or_create(
+        student=student,
+        defaults={
+            'encoding': quantize_embedding(validation_result.pop('embedding')),
+            'scale': QUANTIZATION_SCALE
+        }
+    )
+
+    logger.info("Successfully uploaded profile picture for student %s", student.id)
+
+    # Return updated student data
+    return {
+        "message": "Student face enrolled successfully",
+        "student": StudentSerializer(student, context=serializer_context or {}).data,
+        "face_validation": validation_result
+    }, status.HTTP_200_OK
+
+
+@shared_task
+def enroll_face_task(student_id, image_key, ext):
+    """
+    Background version of enroll_face. The decoded photo is read from the
+    shared cache under `image_key`.
+    """
+    image_data = take_job_image(image_key)
+    if image_data is None:
+        return {
+            "error": "The uploaded photo expired before it was processed. Please try again.",
+            "code": "IMAGE_EXPIRED",
+            "status_code": status.HTTP_400_BAD_REQUEST
+        }
+    payload, status_code = enroll_student_face(Student.objects.get(id=student_id), image_data, ext)
+    return {**payload, "status_code": status_code}
+
+
+@shared_task
+def mark_attendance_task(course_id, image_key, bbox_scale=1.0):
+    """
+    Background version of mark_attendance. The encoded classroom image is
+    read from the shared cache under `image_key`.
+    """
+    image_data = take_job_image(image_key)
+    if image_data is None:
+        return {
+            "error": "The uploaded image expired before it was processed. Please try again.",
+            "code": "IMAGE_EXPIRED"
+        }
+    img = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    del image_data
+    payload, _ = recognize_attendance(course_id, img, bbox_scale)
+    return payload
@@ -1,13 +1,14 @@
 # backend/api/urls.py
 from django.urls import path, include
-from rest_framework.routers import DefaultRouter
-from .views import CourseViewSet, StudentViewSet, DashboardDataView, UserViewSet
+from rest_framework.routers import SimpleRouter
+from .views import CourseViewSet, StudentViewSet, DashboardDataView, UserViewSet, AttendanceJobStatusView
 
 
 
 # SESSION: API ROUTING
 # Create a router and register our viewsets with it.
-router = DefaultRouter()
+# SimpleRouter: the browsable API root and format-suffix routes are not used by the frontend
+router = SimpleRouter()
 router.register(r'courses', CourseViewSet, basename='course')
 router.register(r'students', StudentViewSet, basename='student')
 router.register(r'auth/users', UserViewSet, basename='user')
@@ -16,6 +17,7 @@ router.register(r'auth/users', UserViewSet, basename='user')
 urlpatterns = [
     path('', include(router.urls)),
     path('dashboard-data/', DashboardDataView.as_view(), name='dashboard-data'),
+    path('attendance/jobs/<str:job_id>/', AttendanceJobStatusView.as_view(), name='attendance-job'),
   
 
 ]
\ No newline at end of file
@@ -1,54 +1,269 @@
-import base64
+import binascii
+import itertools
+import logging
 import os
+import secrets
+import time
+import cv2
+try:
+    import pybase64
+except ImportError:  # stdlib fallback with the same API, only slower
+    import base64 as pybase64
 from django.conf import settings
 from rest_framework.response import Response
 from rest_framework import status
 
-def handle_base64_image(base64_image, user_id, type):
+logger = logging.getLogger(__name__)
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+# Base64 characters decoded per write; a multiple of 4 so chunks decode independently
+BASE64_DECODE_CHUNK = 1024 * 1024
+# Supported image signatures and the extension each is saved with, most common first
+IMAGE_SIGNATURES = ((JPEG_MAGIC, 'jpg'), (PNG_MAGIC, 'png'))
+# The same signatures as base64 text: only the characters fully determined by
+# the magic bytes, so they match whatever bytes follow
+BASE64_IMAGE_SIGNATURES = tuple(
+    (pybase64.b64encode(magic)[:len(magic) * 4 // 3].decode('ascii'), ext)
+    for magic, ext in IMAGE_SIGNATURES
+)
+
+
+def _reset_name_prefix():
+    global _name_prefix, _name_counter
+    _name_prefix = f"{os.getpid():x}{secrets.token_hex(4)}"
+    _name_counter = itertools.count()
+
+
+# Generated file names are a per-process prefix plus a counter, so uploads do
+# not each read fresh randomness; forked workers pick a new prefix.
+_reset_name_prefix()
+os.register_at_fork(after_in_child=_reset_name_prefix)
+
+
+def unique_name_suffix():
+    """Suffix that is unique across processes, for photo, report and temp file names."""
+    return f"{_name_prefix}_{next(_name_counter):08x}"
+
+
+def sniff_image_ext(header):
+    """Extension for the image whose first bytes are `header`, or None if unsupported."""
+    for magic, ext in IMAGE_SIGNATURES:
+        if header.startswith(magic):
+            return ext
+    return None
+
+
+def detect_image_ext(base64_image, start=0):
+    """
+    Extension for the base64-encoded image starting at `start`, or None if unsupported.
+    Reads the signature from the text, so nothing is decoded to reject a payload.
+    """
+    head = base64_image[start:start + 16]
+    for signature, ext in BASE64_IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+def base64_payload_start(base64_image):
+    """Index where the base64 text starts, past an optional "data:image/...;base64," prefix."""
+    # The prefix is short, so only the head of a multi-MB payload is searched
+    index = base64_image.find(';base64,', 0, 128)
+    return index + len(';base64,') if index >= 0 else 0
+
+
+def iter_b64decode(text, start=0):
+    """
+    Decode base64 `text` from `start` in BASE64_DECODE_CHUNK pieces.
+    Only chunk-sized slices are copied, and missing padding is added to the last one.
+    """
+    padding = '=' * (-(len(text) - start) % 4)
+    for offset in range(start, len(text), BASE64_DECODE_CHUNK):
+        chunk = text[offset:offset + BASE64_DECODE_CHUNK]
+        if offset + BASE64_DECODE_CHUNK >= len(text):
+            chunk += padding
+        yield pybase64.b64decode(chunk, validate=True)
+
+
+def _image_too_large():
+    return Response({
+        "error": f"Image too large. The maximum size is {settings.MAX_IMAGE_SIZE // (1024 * 1024)}MB.",
+        "code": "PAYLOAD_TOO_LARGE"
+    }, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+
+def _unsupported_format():
+    return Response({
+        "error": "Invalid image format. Only JPEG and PNG are supported.",
+        "code": "UNSUPPORTED_FORMAT"
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _decode_error():
+    return Response({
+        "error": "Invalid image data. Please check the image format.",
+        "code": "DECODE_ERROR"
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _check_base64_image(base64_image):
+    """
+    Validate a base64 image upload without decoding it.
+    Returns (start, ext, None), or (None, None, error_response).
+    """
     if not base64_image:
-        return Response({
+        return None, None, Response({
             "error": "No image data provided.",
             "code": "MISSING_IMAGE"
         }, status=status.HTTP_400_BAD_REQUEST)
 
-    if not os.path.exists(settings.MEDIA_ROOT):
-        os.makedirs(settings.MEDIA_ROOT)
+    # The format is taken from the payload, not the data URL prefix
+    start = base64_payload_start(base64_image)
+    # Every 4 base64 characters decode to 3 bytes, so the size is known up front
+    if (len(base64_image) - start) // 4 * 3 > settings.MAX_IMAGE_SIZE:
+        return None, None, _image_too_large()
+    ext = detect_image_ext(base64_image, start)
+    if ext is None:
+        return None, None, _unsupported_format()
+    return start, ext, None
+
+
+def _check_image_file(image):
+    """
+    Validate a multipart image upload from its size and first bytes.
+    Returns (ext, None), or (None, error_response).
+    """
+    if image.size > settings.MAX_IMAGE_SIZE:
+        return None, _image_too_large()
+    # The format is taken from the bytes, not the client's file name
+    header = image.read(len(PNG_MAGIC))
+    image.seek(0)
+    ext = sniff_image_ext(header)
+    if ext is None:
+        return None, _unsupported_format()
+    return ext, None
+
+
+def decode_base64_image(base64_image):
+    """
+    Decode a base64 image upload in memory.
+    Returns (image_data, ext, None), or (None, None, error_response).
+    """
+    # Encoders such as Android's Base64.DEFAULT wrap lines; the chunked decode
+    # needs the bare alphabet, so only those payloads are copied without them
+    if isinstance(base64_image, str) and ('\n' in base64_image or '\r' in base64_image):
+        base64_image = ''.join(base64_image.split())
+    start, ext, error_response = _check_base64_image(base64_image)
+    if error_response:
+        return None, None, error_response
 
     try:
-        if ';base64,' in base64_image:
-            format, imgstr = base64_image.split(';base64,')
-            ext = format.split('/')[-1].split(';')[0]
-        else:
-            if base64_image.startswith('/9j/'): 
-                ext = 'jpg'
-            elif base64_image.startswith('iVBORw0KGgo'): 
-                ext = 'png'
-            else:
-                return Response({
-                    "error": "Could not determine image format.",
-                    "code": "INVALID_FORMAT"
-                }, status=status.HTTP_400_BAD_REQUEST)
-            imgstr = base64_image
-
-        if ext not in ['jpeg', 'jpg', 'png']:
-            return Response({
-                "error": "Invalid image format. Only JPEG and PNG are supported.",
-                "code": "UNSUPPORTED_FORMAT"
-            }, status=status.HTTP_400_BAD_REQUEST)
-
-        imgstr += '=' * (-len(imgstr) % 4)
-        image_data = base64.b64decode(imgstr)
-
-        temp_filename = f'temp_{type}_{user_id}_{os.urandom(4).hex()}.{ext}'
-        temp_path = os.path.join(settings.MEDIA_ROOT, temp_filename)
-        
-        with open(temp_path, 'wb') as f:
-            f.write(image_data)
-
-        return temp_path, image_data, ext, None
-
-    except Exception as decode_error:
-        return None, None, None, Response({
-            "error": "Invalid image data. Please check the image format.",
-            "code": "DECODE_ERROR"
-        }, status=status.HTTP_400_BAD_REQUEST)
+        # Immutable bytes, so ContentFile's BytesIO shares the buffer instead of
+        # copying it when the photo is saved; a single chunk is returned as is
+        image_data = b''.join(iter_b64decode(base64_image, start))
+    except (binascii.Error, ValueError):
+        # ValueError: non-ASCII characters in the text
+        return None, None, _decode_error()
+
+    return image_data, ext, None
+
+
+def decode_image_upload(image):
+    """
+    Bytes of an uploaded image, sent either as a multipart file (preferred: no
+    base64 inflation or decoding) or as a base64 string in JSON.
+    Returns (image_data, ext, None), or (None, None, error_response).
+    """
+    if not hasattr(image, 'read'):
+        return decode_base64_image(image)
+    ext, error_response = _check_image_file(image)
+    if error_response:
+        return None, None, error_response
+    return image.read(), ext, None
+
+
+def write_file(path, data, exclusive=False):
+    """
+    Write `data` to `path` with unbuffered os.write calls; the bytes are
+    already in memory, so buffered file objects would only copy them.
+    With `exclusive`, an existing file raises FileExistsError instead of
+    being truncated.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if exclusive else os.O_TRUNC)
+    fd = os.open(path, flags, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def save_generated_file(field_file, filename, data):
+    """
+    Store `data` as `filename` under the field's upload_to and point the field
+    at it, without saving the model. The name comes from unique_name_suffix, so
+    the storage's probe for a free name is skipped; the file is still created
+    exclusively, so a clash raises instead of overwriting.
+    """
+    name = field_file.field.generate_filename(field_file.instance, filename)
+    path = field_file.storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file(path, data, exclusive=True)
+    field_file.name = name
+
+
+def remove_file(path, description):
+    """
+    Unlink `path`, treating an already missing file as removed. Other failures
+    are logged, not raised, since callers are cleaning up.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        logger.warning("Error removing %s %s: %s", description, path, e)
+        return
+    logger.info("Removed %s: %s", description, path)
+
+
+def remove_expired_reports():
+    """
+    Remove Excel reports in REPORTS_ROOT the web server has had time to send.
+    Run by the web process whenever it writes a report, since only it can
+    see the directory.
+    """
+    cutoff = time.time() - settings.REPORT_FILE_MAX_AGE
+    removed = 0
+    try:
+        entries = os.scandir(settings.REPORTS_ROOT)
+    except FileNotFoundError:
+        # No report has been written yet
+        return 0
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Error removing report file %s: %s", entry.path, e)
+    if removed:
+        logger.info("Removed %s expired report files", removed)
+    return removed
+
+
+def downscale_image(img):
+    """
+    Shrink a decoded image so its longest edge is at most FACE_IMAGE_MAX_SIDE.
+    Detection time grows with pixel count while the models only need small crops.
+    """
+    height, width = img.shape[:2]
+    scale = settings.FACE_IMAGE_MAX_SIDE / max(height, width)
+    if scale < 1:
+        img = cv2.resize(img, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    return img
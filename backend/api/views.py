@@ -1,21 +1,21 @@
 # Updated views.py with enhanced face recognition
 
-import base64
+import csv
+import itertools
 import numpy as np
 import cv2
 import json
-from datetime import datetime
-import openpyxl
+from datetime import datetime, timedelta
+import xlsxwriter
 import os
-import traceback
+import tempfile
 from typing import Dict, List, Optional
 
 # Django and DRF Imports
 from django.conf import settings
-from django.http import HttpResponse, JsonResponse
-from django.core.files.base import ContentFile
-from django.db.models import Count
-from django.db.models.functions import TruncDay
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.cache import cache
+from django.db.models import CharField, Count, F, Func, Prefetch, Sum, Value
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, status
@@ -23,8 +23,10 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.views import APIView
+from rest_framework.reverse import reverse
 from django.contrib.auth import get_user_model
 from rest_framework.pagination import PageNumberPagination
+from celery.result import AsyncResult
 import logging
 
 # Set up logging
@@ -36,21 +38,31 @@ User = get_user_model()
 from djoser.views import UserViewSet as DjoserUserViewSet
 
 # Local Models
-from .models import Course, Student, AttendanceRecord
+from .models import Course, Student, AttendanceRecord, DailyAttendanceCount, dashboard_cache_key, dashboard_chart_cache_key, invalidate_teacher_dashboard
 
 # Serializer Imports
 from .serializers import (
     CourseSerializer,
     StudentSerializer,
     DashboardCourseSerializer,
-    DashboardRecentAttendanceSerializer,
     UserSerializer,
     NestedStudentSerializer,
     CourseDetailSerializer,
 )
 # Enhanced Face Recognition Service
 from backend.api.face_recognition_service import face_recognition_service
-from .utils import handle_base64_image
+from .utils import decode_image_upload, downscale_image, remove_expired_reports, remove_file, save_generated_file, unique_name_suffix
+from .tasks import enroll_face_task, enroll_student_face, mark_attendance_task, recognize_attendance, stash_job_image
+
+
+REPORT_HEADERS = ["Student ID", "First Name", "Last Name", "Email", "Level", "Status", "Timestamp"]
+
+
+class _Echo:
+    """File-like object whose write() returns the value, so csv.writer rows can be streamed."""
+
+    def write(self, value):
+        return value
 
 
 class StandardResultsSetPagination(PageNumberPagination):
@@ -71,68 +83,75 @@ class UserViewSet(DjoserUserViewSet):
         """
         try:
             user = request.user
-            base64_image = request.data.get('image')
-
-            temp_path, image_data, ext, error_response = handle_base64_image(base64_image, user.id, 'user')
+            image_data, ext, error_response = decode_image_upload(request.data.get('image'))
             if error_response:
                 return error_response
 
-            try:
-                # Validate face in image
-                validation_result = face_recognition_service.validate_face_image(temp_path)
-                
-                if not validation_result['valid']:
-                    os.remove(temp_path)  # Cleanup
-                    return Response({
-                        "error": f"No clear face detected in image: {validation_result.get('error', 'Unknown error')}",
-                        "code": "NO_FACE_DETECTED",
-                        "suggestion": "Please upload a clear photo with your face visible"
-                    }, status=status.HTTP_400_BAD_REQUEST)
+            # Validate the decoded image in memory; the bytes only touch disk once, when saved
+            img = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                return Response({
+                    "error": "Invalid image data. Please check the image format.",
+                    "code": "DECODE_ERROR"
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            # Validate face in image
+            validation_result = face_recognition_service.validate_face_image(img)
+            # The embedding is only stored for students
+            validation_result.pop('embedding', None)
 
-                # If validation passed, save the image
-                image_filename = f'user_{user.id}_{os.urandom(4).hex()}.{ext}'
-                file_content = ContentFile(image_data)
-
-                # Remove old picture
-                if user.profile_picture:
-                    old_path = user.profile_picture.path
-                    if os.path.exists(old_path):
-                        try:
-                            os.remove(old_path)
-                            logger.info(f"Removed old photo: {old_path}")
-                        except OSError as e:
-                            logger.warning(f"Error removing old photo {old_path}: {e}")
-
-                # Save the new file
-                user.profile_picture.save(image_filename, file_content, save=True)
-                
-                logger.info(f"Successfully uploaded profile picture for user {user.id}")
-
-                # Return updated user data
-                serializer = self.get_serializer(user)
+            if not validation_result['valid']:
                 return Response({
-                    "message": "Profile picture uploaded successfully",
-                    "user": serializer.data,
-                    "face_validation": validation_result
-                }, status=status.HTTP_200_OK)
+                    "error": f"No clear face detected in image: {validation_result.get('error', 'Unknown error')}",
+                    "code": "NO_FACE_DETECTED",
+                    "suggestion": "Please upload a clear photo with your face visible"
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            # If validation passed, save the image
+            image_filename = f'user_{user.id}_{unique_name_suffix()}.{ext}'
+
+            old_path = user.profile_picture.path if user.profile_picture else None
 
-            finally:
-                # Cleanup temp file
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
+            # Save the new file before removing the old one, so a failed write
+            # never leaves the user pointing at a deleted picture
+            save_generated_file(user.profile_picture, image_filename, image_data)
+            del image_data
+            user.save(update_fields=['profile_picture'])
+            if old_path:
+                remove_file(old_path, "old photo")
+
+            logger.info("Successfully uploaded profile picture for user %s", user.id)
+
+            # Return updated user data
+            serializer = self.get_serializer(user)
+            return Response({
+                "message": "Profile picture uploaded successfully",
+                "user": serializer.data,
+                "face_validation": validation_result
+            }, status=status.HTTP_200_OK)
 
         except Exception as e:
-            logger.error(f"Unexpected error during profile picture upload: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Unexpected error during profile picture upload: %s", e)
             return Response({
                 "error": "An unexpected error occurred during photo upload.",
                 "code": "INTERNAL_ERROR"
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _local_to_char(field, pattern):
+    """Postgres to_char of a timestamp field in the current time zone."""
+    return Func(
+        Func(Value(timezone.get_current_timezone_name()), F(field), function='timezone'),
+        Value(pattern),
+        function='to_char',
+        output_field=CharField()
+    )
+
+
 class DashboardDataView(APIView):
     """
     API view to fetch data for the dashboard with proper error handling.
+    Any failing query surfaces through the single handler in `get`.
     """
     permission_classes = [IsAuthenticated]
 
@@ -140,54 +159,14 @@ class DashboardDataView(APIView):
         try:
             teacher = request.user
 
-            # Get total counts with error handling
-            try:
-                course_count = Course.objects.filter(teacher=teacher).count()
-                student_count = Student.objects.filter(courses__teacher=teacher).distinct().count()
-            except Exception as e:
-                logger.error(f"Error getting counts for teacher {teacher.id}: {e}")
-                course_count = 0
-                student_count = 0
-
-            # Get recent courses
-            try:
-                recent_courses = Course.objects.filter(teacher=teacher).order_by('-id')[:4]
-                recent_courses_serializer = DashboardCourseSerializer(recent_courses, many=True)
-            except Exception as e:
-                logger.error(f"Error getting recent courses for teacher {teacher.id}: {e}")
-                recent_courses_serializer = DashboardCourseSerializer([], many=True)
+            # The whole payload is cached briefly; attendance, course and
+            # enrollment changes invalidate it sooner
+            cache_key = dashboard_cache_key(teacher.id)
+            data = cache.get(cache_key)
+            if data is not None:
+                return Response(data, status=status.HTTP_200_OK)
 
-            # Get recent attendance
-            try:
-                recent_attendance = AttendanceRecord.objects.filter(
-                    course__teacher=teacher
-                ).select_related('student', 'course').order_by('-timestamp')[:5]
-                recent_attendance_serializer = DashboardRecentAttendanceSerializer(recent_attendance, many=True)
-            except Exception as e:
-                logger.error(f"Error getting recent attendance for teacher {teacher.id}: {e}")
-                recent_attendance_serializer = DashboardRecentAttendanceSerializer([], many=True)
-
-            # Get attendance chart data
-            try:
-                seven_days_ago = timezone.now() - timezone.timedelta(days=7)
-                attendance_by_day = (
-                    AttendanceRecord.objects.filter(
-                        course__teacher=teacher, 
-                        timestamp__gte=seven_days_ago
-                    )
-                    .annotate(day=TruncDay('timestamp'))
-                    .values('day')
-                    .annotate(count=Count('id'))
-                    .order_by('day')
-                )
-
-                chart_data = {
-                    "labels": [entry['day'].strftime('%b %d') for entry in attendance_by_day],
-                    "data": [entry['count'] for entry in attendance_by_day]
-                }
-            except Exception as e:
-                logger.error(f"Error getting chart data for teacher {teacher.id}: {e}")
-                chart_data = {"labels": [], "data": []}
+            course_count, student_count = self.get_counts(teacher)
 
             # Compile response
             data = {
@@ -195,21 +174,142 @@ class DashboardDataView(APIView):
                     'course_count': course_count,
                     'student_count': student_count,
                 },
-                'recent_courses': recent_courses_serializer.data,
-                'recent_attendance': recent_attendance_serializer.data,
-                'attendance_chart': chart_data
+                'recent_courses': self.get_recent_courses(teacher),
+                'recent_attendance': self.get_recent_attendance(teacher),
+                'attendance_chart': self.get_chart_data(teacher)
             }
+            cache.set(cache_key, data, settings.DASHBOARD_CACHE_TIMEOUT)
 
             return Response(data, status=status.HTTP_200_OK)
 
         except Exception as e:
-            logger.error(f"Unexpected error in dashboard data view: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Unexpected error in dashboard data view: %s", e)
             return Response({
                 "error": "Failed to load dashboard data",
                 "code": "DASHBOARD_ERROR"
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def get_counts(self, teacher):
+        # Both counts in one aggregate over the teacher's courses and their students
+        counts = User.objects.filter(pk=teacher.pk).aggregate(
+            course_count=Count('courses', distinct=True),
+            student_count=Count('courses__students', distinct=True)
+        )
+        return counts['course_count'], counts['student_count']
+
+    def get_recent_courses(self, teacher):
+        recent_courses = Course.objects.filter(teacher=teacher).only('id', 'name', 'course_code').annotate(
+            student_count=Count('students')
+        ).order_by('-id')[:4]
+        return DashboardCourseSerializer(recent_courses, many=True).data
+
+    def get_recent_attendance(self, teacher):
+        # Plain rows joined in SQL instead of model instances run through a serializer
+        recent_attendance = AttendanceRecord.objects.filter(
+            course__teacher=teacher
+        ).annotate(
+            # Postgres formats the local time, so no strftime per row
+            timestamp_fmt=_local_to_char('timestamp', 'YYYY-MM-DD HH24:MI')
+        ).order_by('-timestamp').values(
+            'id', 'student__first_name', 'student__last_name', 'student__student_id',
+            'course__name', 'timestamp_fmt', 'is_present'
+        )[:5]
+        return [
+            {
+                'id': record['id'],
+                'student_name': f"{record['student__first_name'] or ''} {record['student__last_name'] or ''}".strip() or record['student__student_id'],
+                'course_name': record['course__name'],
+                'timestamp': record['timestamp_fmt'],
+                'is_present': record['is_present'],
+            }
+            for record in recent_attendance
+        ]
+
+    def get_chart_data(self, teacher):
+        """7-day attendance histogram, cached per teacher until attendance changes."""
+        cache_key = dashboard_chart_cache_key(teacher.id)
+        chart_data = cache.get(cache_key)
+        if chart_data is not None:
+            return chart_data
+
+        # Summed from the daily rollup rather than grouping the raw records
+        seven_days_ago = timezone.localdate() - timedelta(days=7)
+        attendance_by_day = list(
+            DailyAttendanceCount.objects.filter(
+                course__teacher=teacher,
+                day__gte=seven_days_ago
+            )
+            .values('day')
+            # Postgres formats the labels; the rows come back as plain tuples
+            .annotate(
+                total=Sum('count'),
+                label=Func(F('day'), Value('Mon DD'), function='to_char', output_field=CharField())
+            )
+            .filter(total__gt=0)
+            .order_by('day')
+            .values_list('label', 'total')
+        )
+
+        labels, counts = zip(*attendance_by_day) if attendance_by_day else ((), ())
+        chart_data = {
+            "labels": list(labels),
+            "data": list(counts)
+        }
+        cache.set(cache_key, chart_data, settings.DASHBOARD_CACHE_TIMEOUT)
+        return chart_data
+
+
+def _job_owner_cache_key(job_id):
+    return f"job:{job_id}:owner"
+
+
+def _remember_job_owner(job_id, owner):
+    """Record who queued a job, kept as long as Celery keeps its result."""
+    cache.set(_job_owner_cache_key(job_id), owner, settings.CELERY_RESULT_EXPIRES)
+
+
+def _job_not_found():
+    return Response({
+        "error": "Job not found.",
+        "code": "JOB_NOT_FOUND"
+    }, status=status.HTTP_404_NOT_FOUND)
+
+
+def _job_status(job_id, owner, error_message, error_code):
+    """
+    State of a queued Celery job, with its result once finished.
+    Returns None unless the job was queued by `owner`, as recorded by
+    _remember_job_owner, so results are never shown to anyone else.
+    """
+    if cache.get(_job_owner_cache_key(job_id)) != owner:
+        return None
+    job = AsyncResult(job_id)
+    data = {"job_id": job_id, "status": job.state.lower()}
+
+    if job.successful():
+        data["result"] = job.result
+    elif job.failed():
+        logger.error("Job %s failed: %s", job_id, job.result)
+        data["error"] = error_message
+        data["code"] = error_code
+
+    return data
+
+
+class AttendanceJobStatusView(APIView):
+    """
+    Reports the state of a queued mark_attendance job and its result once finished.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id, *args, **kwargs):
+        data = _job_status(
+            job_id, (request.user.id, None), "An unexpected error occurred during attendance marking.", "ATTENDANCE_ERROR"
+        )
+        if data is None:
+            return _job_not_found()
+        return Response(data, status=status.HTTP_200_OK)
+
 
 class CourseViewSet(viewsets.ModelViewSet):
     """
@@ -226,12 +326,17 @@ class CourseViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         """Filters queryset to user's courses with error handling."""
         try:
+            # Courses fetched through the user's related manager already carry the
+            # user as their teacher, so teacher_name needs no join on the user table
             user_courses_qs = self.request.user.courses.all()
             if self.action == 'retrieve':
                 user_courses_qs = user_courses_qs.prefetch_related('students')
+            else:
+                # The list only shows student ids
+                user_courses_qs = user_courses_qs.prefetch_related(Prefetch('students', queryset=Student.objects.only('id')))
             return user_courses_qs
         except Exception as e:
-            logger.error(f"Error getting course queryset for user {self.request.user.id}: {e}")
+            logger.error("Error getting course queryset for user %s: %s", self.request.user.id, e)
             return Course.objects.none()
 
 
@@ -239,25 +344,18 @@ class CourseViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         """Assigns the currently logged-in user as the teacher."""
         try:
-            logger.info(f"Creating course for user: {self.request.user}")
+            logger.info("Creating course for user: %s", self.request.user)
             serializer.save(teacher=self.request.user)
         except Exception as e:
-            logger.error(f"Error creating course for user {self.request.user.id}: {e}")
+            logger.exception("Error creating course for user %s: %s", self.request.user.id, e)
             raise
 
     @action(detail=True, methods=['post'], url_path='enroll-student')
     def enroll_student(self, request, pk=None):
         """Enroll an existing student in a specific course."""
+        # get_queryset only returns the teacher's own courses, so anyone else gets a 404
+        course = self.get_object()
         try:
-            course = self.get_object()
-
-            # Permission check
-            if course.teacher != request.user:
-                return Response({
-                    "error": "You do not have permission to modify this course.",
-                    "code": "PERMISSION_DENIED"
-                }, status=status.HTTP_403_FORBIDDEN)
-
             student_pk_to_enroll = request.data.get('student_pk')
 
             if student_pk_to_enroll is None or student_pk_to_enroll == '':
@@ -270,16 +368,18 @@ class CourseViewSet(viewsets.ModelViewSet):
                 student_pk_integer = int(student_pk_to_enroll)
                 student = Student.objects.get(pk=student_pk_integer)
 
-                # Check if already enrolled
-                if course.students.filter(pk=student.pk).exists():
+                # Enroll through the join table directly; its unique (course, student)
+                # constraint settles "already enrolled" without a separate check
+                _, created = Course.students.through.objects.get_or_create(course_id=course.pk, student_id=student.pk)
+                if not created:
                     return Response({
                         'message': f'Student {student.first_name} {student.last_name} ({student.student_id}) is already enrolled in course {course.course_code}.',
                         'code': 'ALREADY_ENROLLED'
                     }, status=status.HTTP_200_OK)
 
-                # Enroll student
-                course.students.add(student)
-                logger.info(f"Student {student.pk} enrolled in course {course.pk}")
+                # Writing the join row sends no m2m_changed, so refresh the dashboard here
+                invalidate_teacher_dashboard(course.teacher_id)
+                logger.info("Student %s enrolled in course %s", student.pk, course.pk)
 
                 return Response({
                     'message': f'Student {student.first_name} {student.last_name} ({student.student_id}) enrolled successfully in course {course.course_code}.',
@@ -299,8 +399,7 @@ class CourseViewSet(viewsets.ModelViewSet):
                 }, status=status.HTTP_404_NOT_FOUND)
 
         except Exception as e:
-            logger.error(f"Error enrolling student {student_pk_to_enroll} in course {pk}: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error enrolling student %s in course %s: %s", student_pk_to_enroll, pk, e)
             return Response({
                 "error": "An unexpected error occurred during enrollment.",
                 "code": "ENROLLMENT_ERROR"
@@ -309,15 +408,9 @@ class CourseViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'], url_path='remove-student')
     def remove_student(self, request, pk=None):
         """Remove a student from a specific course."""
+        # get_queryset only returns the teacher's own courses, so anyone else gets a 404
+        course = self.get_object()
         try:
-            course = self.get_object()
-
-            if course.teacher != request.user:
-                return Response({
-                    "error": "You do not have permission to modify this course.",
-                    "code": "PERMISSION_DENIED"
-                }, status=status.HTTP_403_FORBIDDEN)
-
             student_pk_to_remove = request.data.get('student_pk')
 
             if student_pk_to_remove is None or student_pk_to_remove == '':
@@ -339,7 +432,7 @@ class CourseViewSet(viewsets.ModelViewSet):
 
                 # Remove student
                 course.students.remove(student)
-                logger.info(f"Student {student.pk} removed from course {course.pk}")
+                logger.info("Student %s removed from course %s", student.pk, course.pk)
 
                 return Response({
                     'message': f'Student {student.first_name} {student.last_name} ({student.student_id}) removed successfully from course {course.course_code}.',
@@ -359,8 +452,7 @@ class CourseViewSet(viewsets.ModelViewSet):
                 }, status=status.HTTP_404_NOT_FOUND)
 
         except Exception as e:
-            logger.error(f"Error removing student {student_pk_to_remove} from course {pk}: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error removing student %s from course %s: %s", student_pk_to_remove, pk, e)
             return Response({
                 "error": "An unexpected error occurred during removal.",
                 "code": "REMOVAL_ERROR"
@@ -371,166 +463,60 @@ class CourseViewSet(viewsets.ModelViewSet):
         """
         Enhanced attendance marking using the new face recognition service
         """
+        # get_queryset only returns the teacher's own courses, so anyone else gets a 404
+        course = self.get_object()
         try:
-            course = self.get_object()
-
-            if course.teacher != request.user:
-                return Response({
-                    "error": "You do not have permission to mark attendance for this course.",
-                    "code": "PERMISSION_DENIED"
-                }, status=status.HTTP_403_FORBIDDEN)
-
-            base64_image = request.data.get('image')
-            if not base64_image:
-                return Response({
-                    "error": "No image data provided.",
-                    "code": "MISSING_IMAGE"
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-            temp_image_path = None
-            present_students_data = []
-            recognized_student_ids = set()
+            # The format comes from the payload's signature, not the data URL
+            image_data, ext, error_response = decode_image_upload(request.data.get('image'))
+            if error_response:
+                return error_response
 
             try:
-                if not os.path.exists(settings.MEDIA_ROOT):
-                    os.makedirs(settings.MEDIA_ROOT)
-
-                # Decode and save image
-                if ';base64,' in base64_image:
-                    format, imgstr = base64_image.split(';base64,')
-                    ext = format.split('/')[-1].split(';')[0]
-                else:
-                    if base64_image.startswith('/9j/'): 
-                        ext = 'jpg'
-                    elif base64_image.startswith('iVBORw0KGgo'): 
-                        ext = 'png'
-                    else:
-                        return Response({
-                            "error": "Could not determine image format.",
-                            "code": "INVALID_FORMAT"
-                        }, status=status.HTTP_400_BAD_REQUEST)
-                    imgstr = base64_image
-
-                if ext not in ['jpeg', 'jpg', 'png']:
-                    return Response({
-                        "error": "Invalid image format. Only JPEG and PNG are supported.",
-                        "code": "UNSUPPORTED_FORMAT"
-                    }, status=status.HTTP_400_BAD_REQUEST)
-
-                imgstr += '=' * (-len(imgstr) % 4)
-                image_data = base64.b64decode(imgstr)
-
-                temp_filename = f"attendance_{os.urandom(8).hex()}.{ext}"
-                temp_image_path = os.path.join(settings.MEDIA_ROOT, temp_filename)
-
-                with open(temp_image_path, 'wb') as f:
-                    f.write(image_data)
-
-                logger.info(f"Saved attendance image: {temp_image_path}")
-
-                # Prepare student data for face database
-                enrolled_students = course.students.all()
-                if not enrolled_students.exists():
-                    return Response({
-                        "error": "No students enrolled in this course.",
-                        "code": "NO_STUDENTS"
-                    }, status=status.HTTP_400_BAD_REQUEST)
-
-                students_data = []
-                students_with_photos = 0
-                
-                for student in enrolled_students:
-                    if student.profile_photo and os.path.exists(student.profile_photo.path):
-                        students_data.append({
-                            'id': student.id,
-                            'profile_photo_path': student.profile_photo.path,
-                            'name': f"{student.first_name} {student.last_name}".strip()
-                        })
-                        students_with_photos += 1
-
-                if not students_data:
+                img = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+                if img is None:
                     return Response({
-                        "error": "No students in this course have face encodings. Please upload student photos.",
-                        "code": "NO_FACE_DATA"
+                        "error": "Invalid image data. Please check the image format.",
+                        "code": "DECODE_ERROR"
                     }, status=status.HTTP_400_BAD_REQUEST)
 
-                logger.info(f"Prepared face database with {students_with_photos} student faces")
-
-                # Prepare face database using enhanced service
-                known_faces_db = face_recognition_service.prepare_student_face_database(students_data)
-
-                if not known_faces_db:
+                # Downscaled copy for the detector; drop the full-size buffers
+                # instead of holding them for the whole request. Bboxes found on
+                # the copy are scaled back to the uploaded image.
+                original_side = max(img.shape[:2])
+                img = downscale_image(img)
+                bbox_scale = original_side / max(img.shape[:2])
+                del image_data
+
+                if settings.ATTENDANCE_ASYNC:
+                    # The worker runs on another machine, so it gets the downscaled
+                    # image re-encoded through the shared cache
+                    image_key = stash_job_image(cv2.imencode(f'.{ext}', img)[1].tobytes())
+                    try:
+                        job = mark_attendance_task.delay(course.id, image_key, bbox_scale)
+                    except Exception:
+                        # Nothing will pick the image up
+                        cache.delete(image_key)
+                        raise
+                    _remember_job_owner(job.id, (request.user.id, None))
                     return Response({
-                        "error": "Failed to prepare face database.",
-                        "code": "DATABASE_ERROR"
-                    }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-                # Find faces in the classroom image using enhanced service
-                face_matches = face_recognition_service.find_faces_in_image_enhanced(temp_image_path, known_faces_db)
-                
-                # Mark attendance
-                today = timezone.now().date()
-                
-                for match in face_matches:
-                    if match.confidence >= 0.7:  # High confidence threshold
-                        try:
-                            student = Student.objects.get(id=match.student_id)
-                            
-                            # Create or update attendance record
-                            record, created = AttendanceRecord.objects.get_or_create(
-                                student=student,
-                                course=course,
-                                timestamp__date=today,
-                                defaults={
-                                    'timestamp': timezone.now(), 
-                                    'is_present': True
-                                }
-                            )
-
-                            if created:
-                                recognized_student_ids.add(match.student_id)
-                                present_students_data.append(StudentSerializer(student).data)
-                                logger.info(f"Marked present: {student.first_name} {student.last_name} (confidence: {match.confidence:.2f})")
-
-                        except Student.DoesNotExist:
-                            logger.warning(f"Student with ID {match.student_id} not found")
-                            continue
+                        "status": "queued",
+                        "job_id": job.id,
+                        "status_url": reverse('attendance-job', kwargs={'job_id': job.id}, request=request)
+                    }, status=status.HTTP_202_ACCEPTED)
 
-                return Response({
-                    "status": "Attendance marked successfully",
-                    "present_students": present_students_data,
-                    "recognized_faces_count": len(recognized_student_ids),
-                    "total_faces_detected": len(face_matches),
-                    "students_with_photos": students_with_photos,
-                    "face_matches": [
-                        {
-                            "student_id": match.student_id,
-                            "confidence": match.confidence,
-                            "bbox": match.bbox
-                        } for match in face_matches
-                    ]
-                }, status=status.HTTP_200_OK)
+                # In-process recognition works on the decoded array, with no disk round trip
+                payload, status_code = recognize_attendance(course.id, img, bbox_scale)
+                return Response(payload, status=status_code)
 
             except Exception as processing_error:
-                logger.error(f"Error processing attendance image: {processing_error}")
-                logger.error(traceback.format_exc())
+                logger.exception("Error processing attendance image: %s", processing_error)
                 return Response({
                     "error": f"Error processing image: {str(processing_error)}",
                     "code": "PROCESSING_ERROR"
                 }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            finally:
-                # Cleanup temporary files
-                if temp_image_path and os.path.exists(temp_image_path):
-                    try:
-                        os.remove(temp_image_path)
-                        logger.info(f"Cleaned up temp image: {temp_image_path}")
-                    except OSError as e:
-                        logger.warning(f"Error removing temp image {temp_image_path}: {e}")
-
         except Exception as e:
-            logger.error(f"Unexpected error in mark_attendance: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Unexpected error in mark_attendance: %s", e)
             return Response({
                 "error": "An unexpected error occurred during attendance marking.",
                 "code": "ATTENDANCE_ERROR"
@@ -538,16 +524,13 @@ class CourseViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['get'], url_path='attendance-report')
     def attendance_report(self, request, pk=None):
-        """Generate Excel attendance report with error handling."""
+        """
+        Generate Excel attendance report with error handling.
+        Pass `report_format=csv` to stream a CSV instead.
+        """
+        # get_queryset only returns the teacher's own courses, so anyone else gets a 404
+        course = self.get_object()
         try:
-            course = self.get_object()
-
-            if course.teacher != request.user:
-                return Response({
-                    "error": "You do not have permission to access reports for this course.",
-                    "code": "PERMISSION_DENIED"
-                }, status=status.HTTP_403_FORBIDDEN)
-
             date_str = request.query_params.get('date')
             if not date_str:
                 return Response({
@@ -563,97 +546,127 @@ class CourseViewSet(viewsets.ModelViewSet):
                     'code': 'INVALID_DATE'
                 }, status=status.HTTP_400_BAD_REQUEST)
 
-            # Get attendance records
+            # Get attendance records; only the student id and time are needed
+            # A timestamp range, unlike __date, can use the (course, timestamp) index
+            day_start = timezone.make_aware(datetime.combine(report_date, datetime.min.time()))
             records = AttendanceRecord.objects.filter(
-                course=course, 
-                timestamp__date=report_date
-            ).select_related('student').order_by('student__student_id')
-
-            present_student_ids = set(records.values_list('student__student_id', flat=True))
-            all_students = course.students.all().order_by('student_id')
-
-            # Create Excel workbook
-            wb = openpyxl.Workbook()
-            ws = wb.active
-            ws.title = f"Attendance {report_date}"
-
-            # Headers
-            headers = ["Student ID", "First Name", "Last Name", "Email", "Level", "Status", "Timestamp"]
-            ws.append(headers)
-
-            # Data rows
-            for student in all_students:
-                status_text = "Present" if student.student_id in present_student_ids else "Absent"
-                attendance_timestamp = ''
-                
-                if status_text == "Present":
-                    record = next((rec for rec in records if rec.student_id == student.id), None)
-                    if record:
-                        attendance_timestamp = record.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-
-                ws.append([
-                    student.student_id or '',
-                    student.first_name or '',
-                    student.last_name or '',
-                    student.email or '',
-                    student.level or '',
-                    status_text,
-                    attendance_timestamp
-                ])
+                course=course,
+                timestamp__gte=day_start,
+                timestamp__lt=day_start + timedelta(days=1)
+            ).values('student_id', 'timestamp')
+
+            # Index the day's timestamps by student once instead of scanning them per student
+            timestamps_by_student_id = {record['student_id']: record['timestamp'] for record in records}
+            if timestamps_by_student_id:
+                # Format every timestamp in one numpy pass instead of a strftime per row
+                student_ids, timestamps = zip(*timestamps_by_student_id.items())
+                formatted = np.char.replace(np.datetime_as_string(
+                    np.array([timestamp.replace(tzinfo=None) for timestamp in timestamps], dtype='datetime64[us]').astype('datetime64[s]'),
+                    unit='s'
+                ), 'T', ' ')
+                timestamps_by_student_id = dict(zip(student_ids, formatted.tolist()))
+            # Plain dicts are enough for the report rows
+            all_students = course.students.all().order_by('student_id').values(
+                'id', 'student_id', 'first_name', 'last_name', 'email', 'level'
+            )
+
+            rows = self._attendance_report_rows(all_students, timestamps_by_student_id)
+            filename = f"attendance_{course.course_code}_{report_date}"
+
+            # CSV fast path: stream rows to the client as they are produced
+            if request.query_params.get('report_format') == 'csv':
+                writer = csv.writer(_Echo())
+                response = StreamingHttpResponse(
+                    (writer.writerow(row) for row in itertools.chain([REPORT_HEADERS], rows)),
+                    content_type='text/csv'
+                )
+                response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+                logger.info("Streaming CSV attendance report for course %s, date %s", course.id, report_date)
+                return response
+
+            # Create Excel workbook; constant_memory flushes each row to a temp
+            # file as it is written instead of keeping the sheet in memory.
+            # Both targets are files, since in_memory would override it.
+            if settings.REPORT_ACCEL_REDIRECT_URL:
+                # Written to disk and sent by the web server with sendfile,
+                # so the file never passes through the WSGI chain
+                os.makedirs(settings.REPORTS_ROOT, exist_ok=True)
+                remove_expired_reports()
+                report_name = f"report_{unique_name_suffix()}.xlsx"
+                target = os.path.join(settings.REPORTS_ROOT, report_name)
+            else:
+                # Deleted once the response closes it
+                target = tempfile.TemporaryFile()
+            wb = xlsxwriter.Workbook(target, {'constant_memory': True})
+            ws = wb.add_worksheet(f"Attendance {report_date}")
+
+            ws.write_row(0, 0, REPORT_HEADERS)
+            for row_number, row in enumerate(rows, 1):
+                ws.write_row(row_number, 0, row)
+            wb.close()
 
             # Create response
-            response = HttpResponse(
-                content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            )
-            response['Content-Disposition'] = f'attachment; filename="attendance_{course.course_code}_{report_date}.xlsx"'
+            if settings.REPORT_ACCEL_REDIRECT_URL:
+                response = HttpResponse(
+                    content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                )
+                response['X-Accel-Redirect'] = settings.REPORT_ACCEL_REDIRECT_URL.rstrip('/') + '/' + report_name
+            else:
+                target.seek(0)
+                response = FileResponse(
+                    target,
+                    content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                )
+            response['Content-Disposition'] = f'attachment; filename="{filename}.xlsx"'
 
-            wb.save(response)
-            logger.info(f"Generated attendance report for course {course.id}, date {report_date}")
+            logger.info("Generated attendance report for course %s, date %s", course.id, report_date)
             return response
 
         except Exception as e:
-            logger.error(f"Error generating attendance report: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error generating attendance report: %s", e)
             return Response({
                 "error": "Failed to generate attendance report.",
                 "code": "REPORT_ERROR"
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @staticmethod
+    def _attendance_report_rows(all_students, timestamps_by_student_id):
+        """Yields one report row per student, shared by the Excel and CSV formats."""
+        for student in all_students:
+            attendance_timestamp = timestamps_by_student_id.get(student['id'], '')
+            status_text = "Present" if attendance_timestamp else "Absent"
+
+            yield [
+                student['student_id'] or '',
+                student['first_name'] or '',
+                student['last_name'] or '',
+                student['email'] or '',
+                student['level'] or '',
+                status_text,
+                attendance_timestamp
+            ]
+
     @action(detail=True, methods=['post'], url_path='debug-face-recognition')
     def debug_face_recognition(self, request, pk=None):
         """
         Debug endpoint to test face recognition with detailed logging.
         Send the same image as both student photo and test image to verify matching.
         """
+        # get_queryset only returns the teacher's own courses, so anyone else gets a 404
+        course = self.get_object()
         try:
-            course = self.get_object()
-            
-            if course.teacher != request.user:
-                return Response({
-                    "error": "Permission denied"
-                }, status=status.HTTP_403_FORBIDDEN)
-            
-            base64_image = request.data.get('image')
-            if not base64_image:
+            image_data, _, error_response = decode_image_upload(request.data.get('image'))
+            if error_response:
+                return error_response
+
+            img = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
                 return Response({
-                    "error": "No image provided"
+                    "error": "Invalid image data"
                 }, status=status.HTTP_400_BAD_REQUEST)
             
-            # Decode image
-            if ';base64,' in base64_image:
-                format, imgstr = base64_image.split(';base64,')
-                ext = format.split('/')[-1].split(';')[0]
-            else:
-                imgstr = base64_image
-                ext = 'jpg'
-            
-            imgstr += '=' * (-len(imgstr) % 4)
-            image_data = base64.b64decode(imgstr)
-            
-            # Save test image
-            test_image_path = os.path.join(settings.MEDIA_ROOT, f'debug_test_{os.urandom(4).hex()}.{ext}')
-            with open(test_image_path, 'wb') as f:
-                f.write(image_data)
+            # DeepFace takes the downscaled array directly, so nothing is written to disk
+            test_image = downscale_image(img)
             
             debug_results = []
             enrolled_students = course.students.all()
@@ -665,7 +678,7 @@ class CourseViewSet(viewsets.ModelViewSet):
                 try:
                     # Test direct DeepFace verification
                     result = DeepFace.verify(
-                        img1_path=test_image_path,
+                        img1_path=test_image,
                         img2_path=student.profile_photo.path,
                         model_name='VGG-Face',
                         distance_metric='cosine',
@@ -688,10 +701,6 @@ class CourseViewSet(viewsets.ModelViewSet):
                         'error': str(e)
                     })
             
-            # Cleanup
-            if os.path.exists(test_image_path):
-                os.remove(test_image_path)
-            
             return Response({
                 'debug_results': debug_results,
                 'total_students_tested': len(debug_results),
@@ -700,7 +709,7 @@ class CourseViewSet(viewsets.ModelViewSet):
             })
             
         except Exception as e:
-            logger.error(f"Debug face recognition error: {e}")
+            logger.error("Debug face recognition error: %s", e)
             return Response({
                 'error': str(e)
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -716,9 +725,16 @@ class StudentViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         """Filters students to user's created students."""
         try:
-            return Student.objects.filter(created_by=self.request.user).distinct()
+            if self.action == 'enrollment_status' or (self.action == 'enroll_face' and settings.ENROLL_FACE_ASYNC):
+                # These only check ownership and use the id, so the row is not
+                # loaded or serialized
+                return Student.objects.filter(created_by=self.request.user).only('id')
+            # StudentSerializer lists each student's course ids
+            return Student.objects.filter(created_by=self.request.user).distinct().prefetch_related(
+                Prefetch('courses', queryset=Course.objects.only('id'))
+            )
         except Exception as e:
-            logger.error(f"Error getting student queryset for user {self.request.user.id}: {e}")
+            logger.error("Error getting student queryset for user %s: %s", self.request.user.id, e)
             return Student.objects.none()
 
     def list(self, request, *args, **kwargs):
@@ -726,7 +742,7 @@ class StudentViewSet(viewsets.ModelViewSet):
         try:
             return super().list(request, *args, **kwargs)
         except Exception as e:
-            logger.error(f"Error in StudentViewSet.list: {e}")
+            logger.error("Error in StudentViewSet.list: %s", e)
             return Response(
                 {"error": "Failed to retrieve students"}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -736,74 +752,64 @@ class StudentViewSet(viewsets.ModelViewSet):
         try:
             serializer.save(created_by=self.request.user)
         except Exception as e:
-            logger.error(f"Error creating student: {e}")
+            logger.exception("Error creating student: %s", e)
             raise
             
     @action(detail=True, methods=['post'], url_path='enroll-face')
     def enroll_face(self, request, pk=None):
         """Enhanced face enrollment with validation"""
+        # get_queryset only returns the user's own students, so the
+        # ownership check already happens in SQL (404 otherwise)
+        student = self.get_object()
         try:
-            student = self.get_object()
-
-            if student.created_by != request.user:
-                return Response({
-                    "error": "You can only upload images for students you created.",
-                    "code": "PERMISSION_DENIED"
-                }, status=status.HTTP_403_FORBIDDEN)
-
-            base64_image = request.data.get('image')
-            temp_path, image_data, ext, error_response = handle_base64_image(base64_image, student.id, 'student')
+            image_data, ext, error_response = decode_image_upload(request.data.get('image'))
             if error_response:
                 return error_response
 
-            try:
-                # Validate face in image
-                validation_result = face_recognition_service.validate_face_image(temp_path)
-                
-                if not validation_result['valid']:
-                    return Response({
-                        "error": f"No clear face detected in image: {validation_result.get('error', 'Unknown error')}",
-                        "code": "NO_FACE_DETECTED",
-                        "suggestion": "Please upload a clear photo with the student's face visible"
-                    }, status=status.HTTP_400_BAD_REQUEST)
-
-                # If validation passed, save the image
-                image_filename = f'student_{student.id}_{os.urandom(4).hex()}.{ext}'
-                file_content = ContentFile(image_data)
-
-                # Remove old picture
-                if student.profile_photo:
-                    old_path = student.profile_photo.path
-                    if os.path.exists(old_path):
-                        try:
-                            os.remove(old_path)
-                            logger.info(f"Removed old photo: {old_path}")
-                        except OSError as e:
-                            logger.warning(f"Error removing old photo {old_path}: {e}")
-
-                # Save the new file
-                student.profile_photo.save(image_filename, file_content, save=True)
-                
-                logger.info(f"Successfully uploaded profile picture for student {student.id}")
-
-                # Return updated student data
-                serializer = self.get_serializer(student)
+            if settings.ENROLL_FACE_ASYNC:
+                # The worker runs on another machine, so it gets the photo
+                # through the shared cache
+                image_key = stash_job_image(image_data)
+                del image_data
+                try:
+                    job = enroll_face_task.delay(student.id, image_key, ext)
+                except Exception:
+                    # Nothing will pick the photo up
+                    cache.delete(image_key)
+                    raise
+                # Status polls must come from this teacher, for this student
+                _remember_job_owner(job.id, (request.user.id, student.id))
                 return Response({
-                    "message": "Student face enrolled successfully",
-                    "student": serializer.data,
-                    "face_validation": validation_result
-                }, status=status.HTTP_200_OK)
+                    "status": "queued",
+                    "job_id": job.id,
+                    "status_url": reverse('student-enrollment-status', kwargs={'pk': student.pk}, request=request) + f"?job_id={job.id}"
+                }, status=status.HTTP_202_ACCEPTED)
 
-            finally:
-                # Cleanup temp file
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
+            payload, status_code = enroll_student_face(student, image_data, ext, self.get_serializer_context())
+            return Response(payload, status=status_code)
 
         except Exception as e:
-            logger.error(f"Unexpected error during student face enrollment: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Unexpected error during student face enrollment: %s", e)
             return Response({
                 "error": "An unexpected error occurred during face enrollment.",
                 "code": "INTERNAL_ERROR"
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=True, methods=['get'], url_path='enrollment-status')
+    def enrollment_status(self, request, pk=None):
+        """Reports the state of a queued enroll_face job, passed as `job_id`."""
+        # Only the owner of the student can poll its enrollment
+        student = self.get_object()
+        job_id = request.query_params.get('job_id')
+        if not job_id:
+            return Response({
+                "error": "'job_id' query parameter is required.",
+                "code": "MISSING_JOB_ID"
+            }, status=status.HTTP_400_BAD_REQUEST)
+        data = _job_status(
+            job_id, (request.user.id, student.id), "An unexpected error occurred during face enrollment.", "ENROLLMENT_ERROR"
+        )
+        if data is None:
+            return _job_not_found()
+        return Response(data, status=status.HTTP_200_OK)
+
@@ -0,0 +1,12 @@
+# backend/celery.py
+import os
+
+from celery import Celery
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+
+app = Celery("backend")
+
+# Read CELERY_* options from Django settings
+app.config_from_object("django.conf:settings", namespace="CELERY")
+app.autodiscover_tasks()
@@ -236,6 +236,29 @@ CHANNEL_LAYERS = {
     },
 }
 
+# --------------------------------------
+# Celery (Background Jobs) Configuration
+# --------------------------------------
+CELERY_BROKER_URL = get_env_variable('CELERY_BROKER_URL', REDIS_URL)
+CELERY_RESULT_BACKEND = get_env_variable('CELERY_RESULT_BACKEND', REDIS_URL)
+CELERY_RESULT_EXPIRES = 3600  # 1 hour
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
+CELERY_ACCEPT_CONTENT = ['json']
+
+# Run mark_attendance on a Celery worker and answer 202 with a job id.
+# Disable to process the image inside the request. The image reaches the
+# worker through the Redis cache, so this needs REDIS_URL and DEBUG off
+# (the local-memory cache is not shared between processes).
+ATTENDANCE_ASYNC = get_env_variable('ATTENDANCE_ASYNC', not DEBUG, cast=bool)
+
+# Run enroll_face's validation and photo storage on a Celery worker and answer
+# 202 with a job id. Off by default: clients expect the enrolled student back.
+# The upload reaches the worker through the Redis cache, but the worker saves
+# the accepted photo under its own MEDIA_ROOT, so the web service must share
+# that storage (it does not on the default Render setup).
+ENROLL_FACE_ASYNC = get_env_variable('ENROLL_FACE_ASYNC', False, cast=bool)
+
 # --------------------------------------
 # Security Settings (Production)
 # --------------------------------------
@@ -308,9 +331,24 @@ os.makedirs(os.path.join(BASE_DIR, 'logs'), exist_ok=True)
 # Face Recognition Settings
 # --------------------------------------
 # Optimize for production deployment
-FACE_RECOGNITION_MODEL = get_env_variable('FACE_RECOGNITION_MODEL', 'ArcFace')
-FACE_RECOGNITION_THRESHOLD = float(get_env_variable('FACE_RECOGNITION_THRESHOLD', '0.68'))
+# Cosine distance under which a live-session face matches a student. Stored
+# encodings are VGG-Face embeddings, so this is tuned for that model.
+FACE_RECOGNITION_THRESHOLD = float(get_env_variable('FACE_RECOGNITION_THRESHOLD', '0.40'))
 FACE_RECOGNITION_BACKEND = get_env_variable('FACE_RECOGNITION_BACKEND', 'opencv')
+# Build the face model at startup instead of on the first request
+FACE_RECOGNITION_PRELOAD = get_env_variable('FACE_RECOGNITION_PRELOAD', not DEBUG, cast=bool)
+# Optional ONNX face detector run through OpenCV DNN, e.g. the INT8 YuNet model
+# (face_detection_yunet_2023mar_int8.onnx). Falls back to DeepFace's detector when unset.
+FACE_DETECTOR_ONNX_PATH = get_env_variable('FACE_DETECTOR_ONNX_PATH')
+# Optional ONNX export of the VGG-Face recognition model, run through ONNX Runtime
+# (needs the onnxruntime package). A statically quantized INT8 (QDQ) export is
+# usually the fastest on CPUs with VNNI. Falls back to DeepFace's model when unset.
+FACE_EMBEDDER_ONNX_PATH = get_env_variable('FACE_EMBEDDER_ONNX_PATH')
+# Processes embedding profile photos without a stored encoding, per web or
+# Celery process. Each loads its own copy of the model (~0.5 GB for VGG-Face).
+FACE_ENCODING_WORKERS = get_env_variable('FACE_ENCODING_WORKERS', 1, cast=int)
+# Longest edge, in pixels, that classroom photos are scaled down to before detection
+FACE_IMAGE_MAX_SIDE = get_env_variable('FACE_IMAGE_MAX_SIDE', 1280, cast=int)
 
 # Memory optimization for face recognition
 if not DEBUG:
@@ -322,7 +360,7 @@ if not DEBUG:
 # --------------------------------------
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'BACKEND': 'django_redis.cache.RedisCache',
         'LOCATION': REDIS_URL,
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
@@ -337,17 +375,29 @@ CACHES = {
     }
 }
 
+# Seconds dashboard aggregates stay cached; attendance changes invalidate them sooner
+DASHBOARD_CACHE_TIMEOUT = get_env_variable('DASHBOARD_CACHE_TIMEOUT', 60, cast=int)
+
 # --------------------------------------
 # File Upload Settings
 # --------------------------------------
-# Limit file upload sizes
+# Largest accepted student/attendance photo, after base64 decoding
+MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5MB
+# Limit file upload sizes; a request body only needs room for one base64 image
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
-DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
+DATA_UPLOAD_MAX_MEMORY_SIZE = MAX_IMAGE_SIZE * 4 // 3 + 64 * 1024
 DATA_UPLOAD_MAX_NUMBER_FIELDS = 1000
 
+# When set, Excel reports are written to REPORTS_ROOT and served by the web server
+# through X-Accel-Redirect at this internal location, e.g. "/internal-reports/"
+# (nginx: `location /internal-reports/ { internal; alias <REPORTS_ROOT>/; }`).
+REPORT_ACCEL_REDIRECT_URL = get_env_variable('REPORT_ACCEL_REDIRECT_URL', None)
+REPORTS_ROOT = get_env_variable('REPORTS_ROOT', os.path.join(BASE_DIR, 'reports'))
+# Seconds a generated report file is kept; older ones are removed when the next report is written
+REPORT_FILE_MAX_AGE = get_env_variable('REPORT_FILE_MAX_AGE', 3600, cast=int)
+
 # Allowed file extensions for student photos
 ALLOWED_IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
-MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5MB
 
 # --------------------------------------
 # Miscellaneous